@@ -0,0 +1,102 @@
+"""
+Benchmark del envío de emails contra un stub local del endpoint de WP Mail.
+
+Compara el envío anterior (requests.post en asyncio.to_thread, una conexión nueva por email) con el
+cliente httpx asíncrono compartido de server.py (keep-alive + concurrencia acotada).
+
+Uso:  python bench_email.py [--emails 200] [--latency-ms 50] [--concurrency 10]
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, como el WordPress real
+    latency = 0.05
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with _StubHandler.lock:
+            _StubHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({"success": True}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_stub(latency: float) -> ThreadingHTTPServer:
+    _StubHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _send_blocking(url: str) -> bool:
+    import requests
+
+    resp = requests.post(url, json={"to": "a@b.c", "subject": "bench", "html": "<p>bench</p>"},
+                         headers={"X-API-Key": "bench"}, timeout=15)
+    return resp.ok and resp.json().get("success")
+
+
+async def _run_before(url: str, emails: int) -> int:
+    results = await asyncio.gather(*(asyncio.to_thread(_send_blocking, url) for _ in range(emails)))
+    return sum(bool(r) for r in results)
+
+
+async def _run_after(emails: int) -> int:
+    import server
+
+    try:
+        results = await asyncio.gather(*(server._send_email_wp("a@b.c", "bench", "<p>bench</p>") for _ in range(emails)))
+    finally:
+        await server._close_email_http()
+    return sum(bool(r) for r in results)
+
+
+def _measure(label: str, run) -> None:
+    _StubHandler.connections = 0
+    t0 = time.perf_counter()
+    ok = run()
+    elapsed = time.perf_counter() - t0
+    print(f"{label:<32} {ok:>5} ok  {elapsed:6.2f}s  {ok / elapsed:8.1f} emails/s  {_StubHandler.connections:>5} conexiones")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    stub = _start_stub(args.latency_ms / 1000)
+    url = f"http://127.0.0.1:{stub.server_port}/wp-json/aqualan/v1/send-email"
+    os.environ["WP_MAIL_ENDPOINT"] = url
+    os.environ["EMAIL_MAX_CONCURRENCY"] = str(args.concurrency)
+    os.environ["EMAIL_QUEUE_TIMEOUT"] = "600"
+
+    print(f"{args.emails} emails, latencia del stub {args.latency_ms:.0f} ms, concurrencia {args.concurrency}")
+    _measure("antes: requests + to_thread", lambda: asyncio.run(_run_before(url, args.emails)))
+    _measure("después: httpx async + pool", lambda: asyncio.run(_run_after(args.emails)))
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
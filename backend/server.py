@@ -1,25 +1,59 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Header, Request
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import time
+import json
+import math
+import csv
+import io
+import tempfile
+import base64
+import hashlib
+import gzip
+import re
 import logging
+import unicodedata
 import asyncio
+import contextlib
+import itertools
+import bisect
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from urllib.parse import parse_qs
+from pydantic import BaseModel, Field, TypeAdapter
+from typing import Dict, List, Optional, Union
 import uuid
+import random
 from datetime import datetime, timedelta, date
 from bson import ObjectId
-import requests as http_requests
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from pymongo import monitoring
+from pymongo.errors import ConnectionFailure
 
-try:
-    import resend
-except ImportError:
-    resend = None
+# httpx, pandas, numpy y Pillow se importan bajo demanda para no alargar el arranque
+
+
+def _process_age() -> float:
+    """Segundos desde que arrancó el proceso (Linux, /proc); 0 si no se puede saber."""
+    try:
+        with open("/proc/self/stat", encoding="ascii") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])  # campo 22: starttime
+        return max(0.0, time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0.0
 
 
+# Referencia para los tiempos de arranque: el inicio del proceso, para que la fase "import" incluya el
+# intérprete y los imports de fastapi/motor/pymongo/pydantic (fuera de Linux, desde este punto del módulo)
+_PROCESS_T0 = time.perf_counter() - _process_age()
+
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -29,6 +63,101 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# httpx registra cada petición a nivel INFO; con el cliente de email compartido sería ruido
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+# Métricas en formato Prometheus (GET /metrics) sin dependencias: contadores e histogramas en memoria del
+# proceso. Cada observación es un bisect y una suma bajo un lock; el texto se genera solo al consultar.
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_str(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{_escape_label(v)}"' for k, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_label_str(self.labelnames, k)} {v:g}" for k, v in sorted(items)]
+
+
+class _Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple, buckets: tuple):
+        self.name, self.help, self.labelnames, self.buckets = name, help_text, labelnames, buckets
+        self._values: Dict[tuple, list] = {}  # labels -> [recuentos por bucket (+Inf al final), suma]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in sorted(items):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_str(self.labelnames, labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_label_str(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+_HTTP_LATENCY = _Histogram("aqualan_http_request_duration_seconds", "Duración de las peticiones HTTP por ruta",
+                           ("method", "route", "status"),
+                           (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+_MONGO_LATENCY = _Histogram("aqualan_mongo_command_duration_seconds", "Duración de los comandos de MongoDB",
+                            ("command", "result"),
+                            (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+_MONGO_ERRORS = _Counter("aqualan_mongo_errors_total", "Errores de MongoDB (comandos fallidos y caídas de conexión)",
+                         ("command",))
+_EMAIL_LATENCY = _Histogram("aqualan_email_send_duration_seconds", "Duración de los envíos de email por proveedor",
+                            ("provider", "result"), (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0))
+_FALLBACKS = _Counter("aqualan_fallback_total", "Operaciones servidas por el fallback local en vez de MongoDB",
+                      ("component",))
+_METRICS = [_HTTP_LATENCY, _MONGO_LATENCY, _MONGO_ERRORS, _EMAIL_LATENCY, _FALLBACKS]
+
+
+class _MongoCommandMetrics(monitoring.CommandListener):
+    """Tiempos de cada comando de MongoDB (lo llama pymongo desde sus hilos)."""
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        _MONGO_LATENCY.observe(event.duration_micros / 1e6, event.command_name, "ok")
+
+    def failed(self, event) -> None:
+        _MONGO_LATENCY.observe(event.duration_micros / 1e6, event.command_name, "error")
+        _MONGO_ERRORS.inc(event.command_name)
+
 
 # MongoDB connection (tolerante a fallos: si falla o URL con placeholder, db=None y se usan productos en memoria)
 client = None
@@ -41,11 +170,68 @@ try:
     if not mongo_url or mongo_url.strip() == 'mongodb://localhost:27017':
         logging.warning("MONGO_URL no configurada o es localhost. Configura MONGO_URL con tu cadena de MongoDB Atlas. Productos y pedidos en memoria.")
     else:
-        client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+        client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000, event_listeners=[_MongoCommandMetrics()])
         db = client[os.environ.get('DB_NAME', 'test_database')]
 except Exception as e:
     logging.warning(f"MongoDB no disponible: {e}. Se usarán productos en memoria.")
 
+# Estado de MongoDB, mantenido por una tarea de fondo que hace ping cada MONGO_HEALTH_INTERVAL segundos.
+# Mientras está caído las peticiones van directas al fallback en memoria, sin esperar al
+# serverSelectionTimeoutMS en cada llamada; el siguiente ping con éxito lo da por recuperado.
+MONGO_HEALTH_INTERVAL = float(os.environ.get("MONGO_HEALTH_INTERVAL", "5"))
+MONGO_PING_TIMEOUT = float(os.environ.get("MONGO_PING_TIMEOUT", "2"))
+_db_health: dict = {"up": db is not None, "latency_ms": None, "checked_at": None, "down_since": None,
+                    "last_error": None, "outages": 0}
+
+
+def db_available() -> bool:
+    return db is not None and _db_health["up"]
+
+
+def _mark_db_down(error) -> None:
+    if _db_health["up"]:
+        logger.warning("MongoDB no disponible (%s): usando el fallback en memoria hasta que se recupere", error)
+        _db_health.update(down_since=datetime.utcnow(), outages=_db_health["outages"] + 1)
+    _db_health.update(up=False, last_error=str(error))
+
+
+def _db_failed(error: Exception) -> None:
+    """Llamar en el except de una operación con MongoDB: si es un fallo de conexión, marca la BD como caída."""
+    if isinstance(error, (ConnectionFailure, asyncio.TimeoutError)):
+        _MONGO_ERRORS.inc("connection")
+        _mark_db_down(error)
+
+
+async def _probe_db() -> bool:
+    if db is None:
+        return False
+    t0 = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), MONGO_PING_TIMEOUT)
+    except Exception as e:
+        _mark_db_down(e)
+    else:
+        if not _db_health["up"]:
+            logger.info("MongoDB recuperado tras %s", datetime.utcnow() - _db_health["down_since"])
+        _db_health.update(up=True, latency_ms=round((time.perf_counter() - t0) * 1000, 1),
+                          down_since=None, last_error=None)
+    _db_health["checked_at"] = datetime.utcnow()
+    return _db_health["up"]
+
+
+async def _db_health_monitor() -> None:
+    while True:
+        await asyncio.sleep(MONGO_HEALTH_INTERVAL)
+        await _probe_db()
+
+
+# FAST_STARTUP=1: carga de rutas y seed de productos en segundo plano; /api/health/ready indica cuándo terminan
+FAST_STARTUP = os.environ.get('FAST_STARTUP', '').lower() in ('1', 'true', 'yes')
+_startup_state: dict = {"ready": False, "pending": set(), "timings_ms": {}, "ready_after_ms": None}
+
+# Clave para endpoints de administración (cabecera X-Admin-Key). Sin clave, están desactivados.
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY', '')
+
 # Email configuration
 EMAIL_TO = 'pedidos@aqualan.es'
 # WordPress WP Mail SMTP — endpoint REST en la web de Aqualan (usa info@aqualan.es)
@@ -63,160 +249,193 @@ app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 
-# Rutas de entrega - Días de reparto por localidad
+# Rutas de entrega - Días de reparto por localidad, agrupadas por ruta (un recorrido de reparto)
 # 0=Lunes, 1=Martes, 2=Miércoles, 3=Jueves, 4=Viernes
-DELIVERY_ROUTES = {
-    # BILBAO - Lunes, Miércoles, Viernes
-    "bilbao": [0, 2, 4],
-    "bilbao-begoña": [0, 2, 4],
-    "bilbao-santutxu": [2],
-    "bilbao-deusto": [2],
-    "bilbao-casco viejo": [0],
-    "bilbao-txurdinaga": [0, 2, 4],
-    "basurtu-zorrotza": [0, 2, 4],
+DELIVERY_ROUTE_GROUPS = {
+    # Lunes, Miércoles, Viernes
+    "BILBAO": {
+        "bilbao": [0, 2, 4],
+        "bilbao-begoña": [0, 2, 4],
+        "bilbao-santutxu": [2],
+        "bilbao-deusto": [2],
+        "bilbao-casco viejo": [0],
+        "bilbao-txurdinaga": [0, 2, 4],
+        "basurtu-zorrotza": [0, 2, 4],
+    },
     
-    # ZAMUDIO-SONDIKA-DERIO-LARRABETZU-LOIU - Lunes
-    "zamudio": [0],
-    "sondika": [0],
-    "derio": [0],
-    "larrabetzu": [0],
-    "loiu": [0],
+    # Lunes
+    "ZAMUDIO-SONDIKA-DERIO-LARRABETZU-LOIU": {
+        "zamudio": [0],
+        "sondika": [0],
+        "derio": [0],
+        "larrabetzu": [0],
+        "loiu": [0],
+    },
     
-    # BASAURI-GALDAKAO-ARTEA-IGORRE - Martes
-    "basauri": [1],
-    "san miguel de basauri": [1],
-    "galdakao": [1],
-    "artea": [1],
-    "igorre": [1],
-    "lemoa": [1],
-    "lemoa-lemona": [1],
-    "dima": [1],
+    # Martes
+    "BASAURI-GALDAKAO-ARTEA-IGORRE": {
+        "basauri": [1],
+        "san miguel de basauri": [1],
+        "galdakao": [1],
+        "artea": [1],
+        "igorre": [1],
+        "lemoa": [1],
+        "lemoa-lemona": [1],
+        "dima": [1],
+    },
     
-    # ELGOIBAR-EIBAR-ERMUA-BERGARA-MONDRAGON - Lunes
-    "elgoibar": [0],
-    "eibar": [0],
-    "ermua": [0],
-    "bergara": [0],
-    "mondragon": [0],
-    "arrasate": [0],
-    "elgeta": [0],
-    "oñati": [0],
-    "aretxabaleta": [0],
-    "mendaro": [0],
-    "mallabia": [0],
-    "zaldibar": [0],
-    "elorrio": [0],
+    # Lunes
+    "ELGOIBAR-EIBAR-ERMUA-BERGARA-MONDRAGON": {
+        "elgoibar": [0],
+        "eibar": [0],
+        "ermua": [0],
+        "bergara": [0],
+        "mondragon": [0],
+        "arrasate": [0],
+        "elgeta": [0],
+        "oñati": [0],
+        "aretxabaleta": [0],
+        "mendaro": [0],
+        "mallabia": [0],
+        "zaldibar": [0],
+        "elorrio": [0],
+    },
     
-    # BERMEO-GERNIKA-ISPASTER-LEKEITIO-BUSTURIA - Miércoles
-    "bermeo": [2],
-    "gernika": [2],
-    "ispaster": [2],
-    "lekeitio": [2],
-    "busturia": [2],
+    # Miércoles
+    "BERMEO-GERNIKA-ISPASTER-LEKEITIO-BUSTURIA": {
+        "bermeo": [2],
+        "gernika": [2],
+        "ispaster": [2],
+        "lekeitio": [2],
+        "busturia": [2],
+    },
     
-    # ASUA-ERANDIO - Martes
-    "asua": [1],
-    "erandio": [1],
-    "asua-erandio": [1],
-    "astrabudua": [1],
+    # Martes
+    "ASUA-ERANDIO": {
+        "asua": [1],
+        "erandio": [1],
+        "asua-erandio": [1],
+        "astrabudua": [1],
+    },
     
-    # DURANGO-AMOREBIETA - Martes
-    "durango": [1],
-    "amorebieta": [1],
-    "amorebieta-etxano": [1],
-    "berriz": [1],
-    "abadiño": [1],
-    "iurreta": [1],
+    # Martes
+    "DURANGO-AMOREBIETA": {
+        "durango": [1],
+        "amorebieta": [1],
+        "amorebieta-etxano": [1],
+        "berriz": [1],
+        "abadiño": [1],
+        "iurreta": [1],
+    },
     
-    # ZIERBENA-SANTURTZI-ORTUELLA-CASTRO - Martes
-    "zierbena": [1],
-    "santurtzi": [1],
-    "ortuella": [1],
-    "castro urdiales": [1],
-    "castro-urdiales": [1],
-    "muskiz": [1],
-    "gallarta": [1],
+    # Martes
+    "ZIERBENA-SANTURTZI-ORTUELLA-CASTRO": {
+        "zierbena": [1],
+        "santurtzi": [1],
+        "ortuella": [1],
+        "castro urdiales": [1],
+        "castro-urdiales": [1],
+        "muskiz": [1],
+        "gallarta": [1],
+    },
     
-    # BALMASEDA-MEDINA DE POMAR - Jueves
-    "balmaseda": [3],
-    "medina de pomar": [3],
-    "villasana de mena": [3],
-    "zalla": [3],
-    "gordexola": [3],
-    "orduña": [3],
+    # Jueves
+    "BALMASEDA-MEDINA DE POMAR": {
+        "balmaseda": [3],
+        "medina de pomar": [3],
+        "villasana de mena": [3],
+        "zalla": [3],
+        "gordexola": [3],
+        "orduña": [3],
+    },
     
-    # GETXO-LEIOA - Miércoles
-    "getxo": [2],
-    "leioa": [2],
-    "algorta": [2],
-    "las arenas-getxo": [2],
-    "andra mari-getxo": [2],
-    "berango": [2],
+    # Miércoles
+    "GETXO-LEIOA": {
+        "getxo": [2],
+        "leioa": [2],
+        "algorta": [2],
+        "las arenas-getxo": [2],
+        "andra mari-getxo": [2],
+        "berango": [2],
+    },
     
-    # AMURRIO-VITORIA - Viernes
-    "amurrio": [4],
-    "vitoria": [4],
-    "vitoria-gasteiz": [4],
-    "vitoria gasteiz": [4],
-    "logroño": [4],
-    "laudio-llodio": [4],
-    "legutio": [4],
-    "legutiano": [4],
-    "nanclares de oca": [4],
-    "alegria-dulantzi": [4],
+    # Viernes
+    "AMURRIO-VITORIA": {
+        "amurrio": [4],
+        "vitoria": [4],
+        "vitoria-gasteiz": [4],
+        "vitoria gasteiz": [4],
+        "logroño": [4],
+        "laudio-llodio": [4],
+        "legutio": [4],
+        "legutiano": [4],
+        "nanclares de oca": [4],
+        "alegria-dulantzi": [4],
+    },
     
-    # SOPELANA-URDULIZ-PLENTZIA-MUNGIA - Miércoles
-    "sopelana": [2],
-    "sopela": [2],
-    "urduliz": [2],
-    "plentzia": [2],
-    "mungia": [2],
-    "gorliz": [2],
+    # Miércoles
+    "SOPELANA-URDULIZ-PLENTZIA-MUNGIA": {
+        "sopelana": [2],
+        "sopela": [2],
+        "urduliz": [2],
+        "plentzia": [2],
+        "mungia": [2],
+        "gorliz": [2],
+    },
     
-    # ETXEBARRI-ARRIGORRIAGA-ZARATAMO - Jueves
-    "etxebarri": [3],
-    "arrigorriaga": [3],
-    "zaratamo": [3],
-    "ugao-miraballes": [3],
-    "orozko": [3],
+    # Jueves
+    "ETXEBARRI-ARRIGORRIAGA-ZARATAMO": {
+        "etxebarri": [3],
+        "arrigorriaga": [3],
+        "zaratamo": [3],
+        "ugao-miraballes": [3],
+        "orozko": [3],
+    },
     
-    # BARAKALDO-PORTUGALETE - Jueves
-    "barakaldo": [3],
-    "portugalete": [3],
-    "sestao": [3],
-    "trapaga": [3],
-    "alonsotegi": [3],
+    # Jueves
+    "BARAKALDO-PORTUGALETE": {
+        "barakaldo": [3],
+        "portugalete": [3],
+        "sestao": [3],
+        "trapaga": [3],
+        "alonsotegi": [3],
+    },
     
-    # CANTABRIA - Martes
-    "santander": [1],
-    "laredo": [1],
-    "colindres": [1],
-    "limpias": [1],
-    "noja": [4],
-    "suances": [1],
-    "camargo": [1],
-    "cicero": [1],
-    "treto": [1],
+    # Martes
+    "CANTABRIA": {
+        "santander": [1],
+        "laredo": [1],
+        "colindres": [1],
+        "limpias": [1],
+        "noja": [4],
+        "suances": [1],
+        "camargo": [1],
+        "cicero": [1],
+        "treto": [1],
+    },
     
-    # DONOSTIALDEA - Jueves
-    "hernani": [3],
-    "donostia": [3],
-    "donostia-san sebastian": [3],
-    "andoain": [3],
-    "lasarte-oria": [3],
-    "lasarte oria": [3],
-    "urnieta": [3],
-    "oiartzun": [3],
-    "errenteria": [3],
-    "pasaia": [3],
-    "lezo": [3],
-    "irun": [3],
-    "tolosa": [3],
-    "azkoitia": [3],
-    "azpeitia": [3],
-    "zarautz": [3],
-    "zumaia": [3],
+    # Jueves
+    "DONOSTIALDEA": {
+        "hernani": [3],
+        "donostia": [3],
+        "donostia-san sebastian": [3],
+        "andoain": [3],
+        "lasarte-oria": [3],
+        "lasarte oria": [3],
+        "urnieta": [3],
+        "oiartzun": [3],
+        "errenteria": [3],
+        "pasaia": [3],
+        "lezo": [3],
+        "irun": [3],
+        "tolosa": [3],
+        "azkoitia": [3],
+        "azpeitia": [3],
+        "zarautz": [3],
+        "zumaia": [3],
+    },
 }
+DELIVERY_ROUTES = {city: days for cities in DELIVERY_ROUTE_GROUPS.values() for city, days in cities.items()}
 
 DAY_NAMES = {
     0: "Lunes",
@@ -266,6 +485,13 @@ ROUTES_14_DAYS: dict = {
     "alonsotegi": {"semana": 2, "days": [3]},
 }
 
+# Copia de las rutas por defecto: cada recarga parte de aquí y añade lo que venga del Excel
+_ROUTES_14_DAYS_FALLBACK = dict(ROUTES_14_DAYS)
+# Recarga en caliente de rutas.xlsx (segundos entre comprobaciones; 0 = desactivado)
+ROUTES_WATCH_INTERVAL = float(os.environ.get("ROUTES_WATCH_INTERVAL", "30"))
+_routes_reload_lock = threading.Lock()
+_routes_state: dict = {"source_mtime_ns": None, "excel_routes": 0, "loaded_at": None, "last_error": None}
+
 
 def _current_semana(d: date) -> int:
     """Devuelve 2 si la semana de d es Semana 2, 1 si es Semana 1 (ciclo 14 días desde REFERENCE_MONDAY)."""
@@ -274,54 +500,174 @@ def _current_semana(d: date) -> int:
     return 2 if weeks_since_ref % 2 == 0 else 1
 
 
+ROUTES_XLSX = ROOT_DIR.parent / "rutas.xlsx"
+# Artefacto compilado de rutas: evita parsear el Excel en cada arranque mientras rutas.xlsx no cambie
+ROUTES_ARTIFACT = Path(os.environ.get("ROUTES_ARTIFACT", str(ROOT_DIR / ".cache" / "rutas.compiled.json")))
+_ROUTES_ARTIFACT_VERSION = 1
+_EXCEL_CITY_COL = "Clientes asignados/Ciudad"
+_EXCEL_DAY_COLS = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes"]
+
+
+def _parse_routes_excel(xlsx_path: Path) -> dict:
+    """Lee rutas.xlsx con operaciones por columna y devuelve {ciudad: {"semana": 1|2, "days": [...]}}.
+    Los días de reparto se indican en la fila de cabecera de cada ruta y se arrastran a sus filas."""
+    import numpy as np
+    import pandas as pd
+
+    df = pd.read_excel(xlsx_path, engine="openpyxl", header=0)
+    if _EXCEL_CITY_COL not in df.columns or not all(c in df.columns for c in _EXCEL_DAY_COLS):
+        return {}
+    # La columna con SEMANA 1 / SEMANA 2 no tiene cabecera fija: se busca solo entre columnas de texto
+    period_col = None
+    for c in df.columns.difference([_EXCEL_CITY_COL, *_EXCEL_DAY_COLS], sort=False):
+        if pd.api.types.is_numeric_dtype(df[c]):
+            continue
+        if df[c].dropna().astype(str).str.contains("SEMANA 1|SEMANA 2", regex=True, case=False).any():
+            period_col = c
+            break
+    if period_col is None:
+        return {}
+
+    city = df[_EXCEL_CITY_COL]
+    city = city.where(city.map(lambda v: isinstance(v, str))).str.strip()
+    df = df[city.fillna("").ne("")]
+    city = city.loc[df.index]
+
+    flags = df[_EXCEL_DAY_COLS].apply(pd.to_numeric, errors="coerce").eq(1)
+    mask = flags.to_numpy().astype("int64") @ (1 << np.arange(5))
+    day_mask = pd.Series(mask, index=df.index).where(flags.any(axis=1)).ffill()
+
+    period = df[period_col].fillna("").astype(str).str.upper()
+    semana = pd.Series(pd.NA, index=df.index, dtype="Int8")
+    semana[period.str.contains("SEMANA 2", regex=False)] = 2
+    semana[period.str.contains("SEMANA 1", regex=False)] = 1
+
+    out = pd.DataFrame({"city": city.str.lower(), "semana": semana, "mask": day_mask})
+    out = out.dropna().drop_duplicates("city", keep="last")
+    return {
+        row.city: {"semana": int(row.semana), "days": [d for d in range(5) if int(row.mask) >> d & 1]}
+        for row in out.itertuples(index=False)
+    }
+
+
+def _file_sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def _read_routes_artifact(xlsx_path: Path) -> Optional[dict]:
+    """Devuelve las rutas del artefacto si corresponde al rutas.xlsx actual (mtime o, si no, hash)."""
+    try:
+        artifact = json.loads(ROUTES_ARTIFACT.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if artifact.get("version") != _ROUTES_ARTIFACT_VERSION:
+        return None
+    st = xlsx_path.stat()
+    if artifact.get("source_mtime_ns") == st.st_mtime_ns and artifact.get("source_size") == st.st_size:
+        return artifact.get("routes")
+    digest = _file_sha256(xlsx_path)
+    if artifact.get("source_sha256") == digest:
+        # Mismo contenido con otra fecha (p. ej. tras un git checkout): se actualiza el mtime guardado
+        _write_routes_artifact(xlsx_path, digest, artifact.get("routes") or {})
+        return artifact.get("routes")
+    return None
+
+
+def _write_routes_artifact(xlsx_path: Path, digest: str, routes: dict) -> None:
+    st = xlsx_path.stat()
+    artifact = {
+        "version": _ROUTES_ARTIFACT_VERSION,
+        "source_mtime_ns": st.st_mtime_ns,
+        "source_size": st.st_size,
+        "source_sha256": digest,
+        "routes": routes,
+    }
+    try:
+        ROUTES_ARTIFACT.parent.mkdir(parents=True, exist_ok=True)
+        tmp = ROUTES_ARTIFACT.with_suffix(".tmp")
+        tmp.write_text(json.dumps(artifact, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, ROUTES_ARTIFACT)
+    except OSError as e:
+        logging.warning("No se pudo guardar el artefacto de rutas %s: %s", ROUTES_ARTIFACT, e)
+
+
+def _validate_routes(routes: dict) -> None:
+    """Comprueba que la tabla de rutas SEMANA 1/2 es utilizable antes de publicarla."""
+    if not routes:
+        raise ValueError("rutas.xlsx no contiene rutas SEMANA 1 / SEMANA 2")
+    for city, info in routes.items():
+        if not isinstance(city, str) or not city.strip():
+            raise ValueError(f"Ciudad vacía en rutas.xlsx: {city!r}")
+        if info.get("semana") not in (1, 2):
+            raise ValueError(f"Semana inválida para {city}: {info.get('semana')!r}")
+        days = info.get("days")
+        if not days or any(not isinstance(d, int) or d not in DAY_NAMES for d in days):
+            raise ValueError(f"Días de reparto inválidos para {city}: {days!r}")
+
+
+def _read_excel_routes(xlsx_path: Path) -> dict:
+    """Rutas SEMANA 1/2 de rutas.xlsx, desde el artefacto compilado si el Excel no ha cambiado."""
+    routes = _read_routes_artifact(xlsx_path)
+    if routes is None:
+        routes = _parse_routes_excel(xlsx_path)
+        _validate_routes(routes)
+        _write_routes_artifact(xlsx_path, _file_sha256(xlsx_path), routes)
+        logger.info("rutas.xlsx parseado: %d rutas SEMANA 1/2", len(routes))
+    else:
+        _validate_routes(routes)
+    return routes
+
+
+def reload_routes() -> dict:
+    """Vuelve a leer rutas.xlsx y publica la nueva tabla con su índice de una sola vez.
+    Si el Excel no es válido se lanza ValueError y se mantiene la tabla actual."""
+    with _routes_reload_lock:
+        xlsx_path = ROUTES_XLSX
+        routes = _read_excel_routes(xlsx_path) if xlsx_path.exists() else {}
+        _install_routes({**_ROUTES_14_DAYS_FALLBACK, **routes})
+        _routes_state.update({
+            "source_mtime_ns": xlsx_path.stat().st_mtime_ns if xlsx_path.exists() else None,
+            "excel_routes": len(routes),
+            "loaded_at": datetime.utcnow(),
+            "last_error": None,
+        })
+        return dict(_routes_state)
+
+
 def _load_routes_from_excel() -> None:
-    """Carga rutas con SEMANA 1 / SEMANA 2 y días desde rutas.xlsx (columnas L-V y periodicidad)."""
-    global ROUTES_14_DAYS
-    xlsx_path = ROOT_DIR.parent / "rutas.xlsx"
-    if not xlsx_path.exists():
-        return
+    """Carga rutas con SEMANA 1 / SEMANA 2 y días desde rutas.xlsx (columnas L-V y periodicidad).
+    Usa el artefacto compilado si rutas.xlsx no ha cambiado desde la última vez."""
     try:
-        import pandas as pd
-        df = pd.read_excel(xlsx_path, engine="openpyxl", header=0)
-        city_col = "Clientes asignados/Ciudad"
-        day_names = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes"]
-        period_col = None
-        for c in df.columns:
-            s = df[c].dropna().astype(str)
-            if s.str.contains("SEMANA 1|SEMANA 2", regex=True, case=False).any():
-                period_col = c
-                break
-        if period_col is None or city_col not in df.columns:
-            return
-        current_days = None
-        for _, row in df.iterrows():
-            city = row.get(city_col)
-            if pd.isna(city) or not isinstance(city, str) or not str(city).strip():
-                continue
-            period = row.get(period_col)
-            if pd.isna(period):
-                period = ""
-            period_str = str(period).strip().upper()
-            days_row = []
-            for dc in day_names:
-                if dc not in df.columns:
-                    continue
-                v = row.get(dc)
-                if v is True or (isinstance(v, (int, float)) and not pd.isna(v) and int(v) == 1):
-                    days_row.append(True)
-                else:
-                    days_row.append(False)
-            if len(days_row) == 5 and any(days_row):
-                current_days = [i for i in range(5) if days_row[i]]
-            if "SEMANA 1" in period_str or "SEMANA 2" in period_str:
-                semana = 1 if "SEMANA 1" in period_str else 2
-                if current_days:
-                    key = str(city).lower().strip()
-                    ROUTES_14_DAYS[key] = {"semana": semana, "days": current_days}
+        reload_routes()
     except Exception as e:
+        _routes_state["last_error"] = str(e)
         logging.warning("No se pudo cargar rutas.xlsx para SEMANA 1/2: %s", e)
 
 
+def _routes_file_mtime() -> Optional[int]:
+    try:
+        return ROUTES_XLSX.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+async def _watch_routes_file() -> None:
+    """Tarea de fondo: recarga las rutas cuando cambia rutas.xlsx, parseando fuera del event loop."""
+    last_mtime = _routes_file_mtime()
+    while True:
+        await asyncio.sleep(ROUTES_WATCH_INTERVAL)
+        mtime = _routes_file_mtime()
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        try:
+            state = await asyncio.to_thread(reload_routes)
+            logger.info("rutas.xlsx recargado en caliente: %d rutas SEMANA 1/2", state["excel_routes"])
+        except Exception as e:
+            _routes_state["last_error"] = str(e)
+            logger.warning("rutas.xlsx modificado pero no válido, se mantienen las rutas actuales: %s", e)
+
+
 def _next_delivery_14_days(route_semana: int, delivery_weekdays: List[int], today: date) -> date:
     """
     Próxima fecha de entrega para ruta cada 14 días.
@@ -349,72 +695,132 @@ def _next_delivery_14_days(route_semana: int, delivery_weekdays: List[int], toda
     return next_semana_monday + timedelta(days=first_weekday)
 
 
-def get_next_delivery_date(city: str) -> dict:
-    """Calcula la próxima fecha de entrega basada en la ciudad (rutas 7 días o 14 días con Semana 1/2)."""
-    city_lower = city.lower().strip()
-    today = datetime.now().date()
-
-    # 1) Rutas cada 14 días (SEMANA 1 / SEMANA 2 desde Excel o fallback)
-    for route_city, info in ROUTES_14_DAYS.items():
-        if route_city in city_lower or city_lower in route_city:
-            delivery_date = _next_delivery_14_days(
-                info["semana"], info["days"], today
-            )
-            return {
-                "found": True,
-                "message": f"Tu pedido llegará el {DAY_NAMES[delivery_date.weekday()]} {delivery_date.strftime('%d/%m/%Y')}",
-                "date": delivery_date.strftime('%Y-%m-%d'),
-                "day_name": DAY_NAMES[delivery_date.weekday()],
-            }
-    # Coincidencia parcial para 14 días
-    for route_city, info in ROUTES_14_DAYS.items():
-        if any(word in city_lower for word in route_city.split("-")) or \
-           any(word in route_city for word in city_lower.split()):
-            delivery_date = _next_delivery_14_days(
-                info["semana"], info["days"], today
-            )
-            return {
-                "found": True,
-                "message": f"Tu pedido llegará el {DAY_NAMES[delivery_date.weekday()]} {delivery_date.strftime('%d/%m/%Y')}",
-                "date": delivery_date.strftime('%Y-%m-%d'),
-                "day_name": DAY_NAMES[delivery_date.weekday()],
-            }
-
-    # 2) Rutas cada 7 días (lógica actual)
-    delivery_days = None
-    for route_city, days in DELIVERY_ROUTES.items():
-        if route_city in city_lower or city_lower in route_city:
-            delivery_days = days
-            break
-    if delivery_days is None:
-        for route_city, days in DELIVERY_ROUTES.items():
-            if any(word in city_lower for word in route_city.split('-')) or \
-               any(word in route_city for word in city_lower.split()):
-                delivery_days = days
-                break
-
-    if delivery_days is None:
-        return {
-            "found": False,
-            "message": "Te contactaremos para confirmar la fecha de entrega",
-            "date": None,
-            "day_name": None
-        }
-
+# Índice compilado de rutas: se construye al arrancar y cada vez que se recargan las rutas.
+# Precedencia (determinista, no depende del orden de los dicts):
+#   1) nombre completo normalizado (si existe en ambas tablas, gana la ruta de 14 días)
+#   2) fragmento exacto del texto (el más largo y, a igualdad, el más a la izquierda)
+#   3) el texto es el comienzo de una ruta, aunque sea a media palabra ("las arenas", "barakald")
+#   4) palabra suelta significativa ("santutxu" -> "bilbao-santutxu")
+#   5) comienzo de una palabra significativa ("santut", "donosti"): el endpoint se consulta a cada tecla
+# En 3), 4) y 5), si varias rutas coinciden gana la de nombre más corto y luego la alfabética.
+# Los prefijos a media palabra exigen al menos _ROUTE_MIN_PREFIX letras.
+_ROUTE_STOPWORDS = {"de", "del", "la", "las", "los", "el", "san", "santa", "y"}
+_CITY_SEPARATORS_RE = re.compile(r"[^0-9a-z]+")
+_ROUTE_MIN_PREFIX = 3
+_ROUTE_INDEX: dict = {"exact": {}, "prefix": {}, "token": {}, "token_prefix": {}, "max_tokens": 0, "generation": 0}
+_route_generations = itertools.count(1)
+
+
+def _normalize_city(city: str) -> str:
+    """Minúsculas, sin tildes y con guiones/comas/espacios colapsados a un único espacio."""
+    text = unicodedata.normalize("NFKD", (city or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(_CITY_SEPARATORS_RE.split(text)).strip()
+
+
+def _build_route_index(routes_14: dict, routes_7: dict) -> dict:
+    """Construye los diccionarios exacto / prefijo / palabra a partir de las tablas de rutas. Cada entrada
+    lleva su ruta de reparto (DELIVERY_ROUTE_GROUPS; una localidad solo del Excel es su propia ruta)."""
+    route_of = {_normalize_city(city): route for route, cities in DELIVERY_ROUTE_GROUPS.items() for city in cities}
+    exact = {}
+    for key, days in routes_7.items():
+        norm = _normalize_city(key)
+        exact[norm] = {"key": key, "route": route_of.get(norm, key.upper()), "semana": None, "days": sorted(days)}
+    for key, info in routes_14.items():
+        norm = _normalize_city(key)
+        exact[norm] = {"key": key, "route": route_of.get(norm, key.upper()), "semana": info["semana"],
+                       "days": sorted(info["days"])}
+    exact.pop("", None)
+
+    prefix, token, token_prefix = {}, {}, {}
+    for norm, entry in sorted(exact.items(), key=lambda kv: (len(kv[0]), kv[0])):
+        words = norm.split()
+        for i in range(1, len(words)):
+            prefix.setdefault(" ".join(words[:i]), entry)
+        for i in range(_ROUTE_MIN_PREFIX, len(norm)):
+            prefix.setdefault(norm[:i].rstrip(), entry)
+        for w in words:
+            if len(w) >= 3 and w not in _ROUTE_STOPWORDS:
+                token.setdefault(w, entry)
+                for i in range(_ROUTE_MIN_PREFIX, len(w)):
+                    token_prefix.setdefault(w[:i], entry)
+    max_tokens = max((len(k.split()) for k in exact), default=0)
+    return {"exact": exact, "prefix": prefix, "token": token, "token_prefix": token_prefix,
+            "max_tokens": max_tokens}
+
+
+def _install_routes(routes_14: dict) -> None:
+    """Construye el índice completo y lo publica con una única asignación: las peticiones concurrentes
+    ven la tabla anterior entera o la nueva entera, nunca una a medio construir."""
+    global ROUTES_14_DAYS, _ROUTE_INDEX
+    index = _build_route_index(routes_14, DELIVERY_ROUTES)
+    index["generation"] = next(_route_generations)
+    ROUTES_14_DAYS = routes_14
+    _ROUTE_INDEX = index
+    _clear_delivery_cache()
+    logger.info("Índice de rutas: %d localidades", len(index["exact"]))
+
+
+def _resolve_route(city: str, index: Optional[dict] = None) -> Optional[dict]:
+    """Devuelve la entrada de ruta ({"key", "semana", "days"}) para la ciudad o None."""
+    if index is None:
+        index = _ROUTE_INDEX
+    norm = _normalize_city(city)
+    if not norm:
+        return None
+    exact = index["exact"]
+    entry = exact.get(norm)
+    if entry is not None:
+        return entry
+    words = norm.split()
+    for size in range(min(len(words), index["max_tokens"]), 0, -1):
+        for start in range(len(words) - size + 1):
+            entry = exact.get(" ".join(words[start:start + size]))
+            if entry is not None:
+                return entry
+    entry = index["prefix"].get(norm)
+    if entry is not None:
+        return entry
+    for w in words:
+        entry = index["token"].get(w)
+        if entry is not None:
+            return entry
+    for w in words:
+        entry = index["token_prefix"].get(w)
+        if entry is not None:
+            return entry
+    return None
+
+
+def _delivery_date_for_route(entry: dict, now: datetime) -> date:
+    """Fecha de entrega para una ruta ya resuelta (14 días con Semana 1/2 o semanal con corte a las 10:00)."""
+    today = now.date()
+    if entry["semana"] is not None:
+        return _next_delivery_14_days(entry["semana"], entry["days"], today)
+
+    delivery_days = entry["days"]
     current_weekday = today.weekday()
-    current_hour = datetime.now().hour
     days_to_add = None
     for day in delivery_days:
         if day > current_weekday:
             days_to_add = day - current_weekday
             break
-        elif day == current_weekday and current_hour < 10:
+        elif day == current_weekday and now.hour < 10:
             days_to_add = 0
             break
     if days_to_add is None:
         days_to_add = (7 - current_weekday) + delivery_days[0]
-    delivery_date = today + timedelta(days=days_to_add)
+    return today + timedelta(days=days_to_add)
 
+
+def _delivery_info(delivery_date: Optional[date]) -> dict:
+    if delivery_date is None:
+        return {
+            "found": False,
+            "message": "Te contactaremos para confirmar la fecha de entrega",
+            "date": None,
+            "day_name": None
+        }
     return {
         "found": True,
         "message": f"Tu pedido llegará el {DAY_NAMES[delivery_date.weekday()]} {delivery_date.strftime('%d/%m/%Y')}",
@@ -423,6 +829,159 @@ def get_next_delivery_date(city: str) -> dict:
     }
 
 
+def _compute_delivery_info(city: str, now: datetime, index: Optional[dict] = None) -> dict:
+    """Resuelve la ruta y calcula la fecha de entrega sin pasar por la caché."""
+    entry = _resolve_route(city, index)
+    return _delivery_info(None if entry is None else _delivery_date_for_route(entry, now))
+
+
+# Caché LRU de fechas de entrega por ciudad normalizada. Todas las entradas caducan a la vez
+# cuando cambia el día, cuando se pasa el corte de las 10:00 o cuando se recargan las rutas.
+DELIVERY_CACHE_SIZE = int(os.environ.get("DELIVERY_CACHE_SIZE", "2048"))
+_delivery_cache: "OrderedDict[str, dict]" = OrderedDict()
+_delivery_cache_epoch: Optional[tuple] = None
+_delivery_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+_delivery_cache_lock = threading.Lock()
+
+
+def _clear_delivery_cache() -> None:
+    with _delivery_cache_lock:
+        _delivery_cache.clear()
+        _delivery_cache_stats["invalidations"] += 1
+
+
+def delivery_cache_stats() -> dict:
+    with _delivery_cache_lock:
+        stats = dict(_delivery_cache_stats)
+        stats["size"] = len(_delivery_cache)
+    total = stats["hits"] + stats["misses"]
+    stats["max_size"] = DELIVERY_CACHE_SIZE
+    stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+    return stats
+
+
+def get_next_delivery_date(city: str) -> dict:
+    """Calcula la próxima fecha de entrega basada en la ciudad (rutas 7 días o 14 días con Semana 1/2)."""
+    global _delivery_cache_epoch
+    now = datetime.now()
+    key = _normalize_city(city)
+    index = _ROUTE_INDEX
+    epoch = (now.date(), now.hour >= 10, index["generation"])
+    with _delivery_cache_lock:
+        if epoch != _delivery_cache_epoch:
+            if _delivery_cache:
+                _delivery_cache_stats["invalidations"] += 1
+            _delivery_cache.clear()
+            _delivery_cache_epoch = epoch
+        cached = _delivery_cache.get(key)
+        if cached is not None:
+            _delivery_cache.move_to_end(key)
+            _delivery_cache_stats["hits"] += 1
+            return dict(cached)
+        _delivery_cache_stats["misses"] += 1
+
+    info = _compute_delivery_info(key, now, index)
+
+    with _delivery_cache_lock:
+        if epoch == _delivery_cache_epoch:
+            _delivery_cache[key] = info
+            if len(_delivery_cache) > DELIVERY_CACHE_SIZE:
+                _delivery_cache.popitem(last=False)
+                _delivery_cache_stats["evictions"] += 1
+    return dict(info)
+
+
+def get_delivery_dates(cities: List[str], reference: Optional[datetime] = None) -> List[dict]:
+    """Fechas de entrega para varias ciudades; cada ciudad distinta (normalizada) se resuelve una sola vez.
+    Sin fecha de referencia se usa la caché; con fecha de referencia se calcula para ese momento."""
+    resolved: dict = {}
+    results = []
+    for city in cities:
+        key = _normalize_city(city)
+        info = resolved.get(key)
+        if info is None:
+            info = get_next_delivery_date(key) if reference is None else _compute_delivery_info(key, reference)
+            resolved[key] = info
+        results.append({"city": city, **info})
+    return results
+
+
+# Calendario de reparto: próximas N fechas de todas las localidades, calculado con NumPy sobre la tabla
+# completa de rutas una vez por día (y por corte de las 10:00). Se invalida al recargar las rutas.
+CALENDAR_MAX_DATES = int(os.environ.get("CALENDAR_MAX_DATES", "12"))
+_calendar_cache: Optional[dict] = None
+
+
+def _build_delivery_calendar(now: datetime, n: int, index: dict) -> List[dict]:
+    """Próximas n fechas de entrega por localidad con la misma norma que get_next_delivery_date:
+    rutas semanales con corte a las 10:00 el mismo día; rutas de 14 días en su primer día de reparto
+    de la Semana 1/2 que les toca."""
+    import numpy as np
+
+    entries = sorted(index["exact"].values(), key=lambda e: e["key"])
+    allowed = np.zeros((len(entries), 7), dtype=bool)
+    semana = np.zeros(len(entries), dtype=np.int8)
+    for i, e in enumerate(entries):
+        if e["semana"] is None:
+            allowed[i, e["days"]] = True
+        else:
+            allowed[i, min(e["days"])] = True
+            semana[i] = e["semana"]
+
+    # Horizonte suficiente para n repartos de una ruta de 14 días con un único día
+    dates = np.datetime64(now.date(), "D") + np.arange(14 * (n + 1))
+    weekdays = (dates.astype("int64") + 3) % 7  # 1970-01-01 fue jueves
+    mondays = dates - weekdays
+    weeks_since_ref = (mondays - np.datetime64(REFERENCE_MONDAY, "D")).astype("int64") // 7
+    date_semana = np.where(weeks_since_ref % 2 == 0, 2, 1)
+
+    eligible = allowed[:, weekdays] & ((semana[:, None] == 0) | (semana[:, None] == date_semana[None, :]))
+    if now.hour >= 10:
+        eligible[semana == 0, 0] = False
+    eligible &= np.cumsum(eligible, axis=1) <= n
+    rows, cols = np.nonzero(eligible)
+    labels = np.datetime_as_string(dates[cols], unit="D")
+
+    per_route: List[List[str]] = [[] for _ in entries]
+    for r, label in zip(rows.tolist(), labels.tolist()):
+        per_route[r].append(label)
+    return [
+        {
+            "city": e["key"],
+            "scheme": "7_dias" if e["semana"] is None else "14_dias",
+            "semana": e["semana"],
+            "days": [DAY_NAMES[d] for d in e["days"]],
+            "dates": per_route[i],
+        }
+        for i, e in enumerate(entries)
+    ]
+
+
+def get_delivery_calendar(n: int) -> dict:
+    """Calendario cacheado; se calcula con CALENDAR_MAX_DATES fechas y se recorta a n."""
+    global _calendar_cache
+    now = datetime.now()
+    index = _ROUTE_INDEX
+    epoch = (now.date(), now.hour >= 10, index["generation"])
+    cache = _calendar_cache
+    if cache is None or cache["epoch"] != epoch:
+        cache = {
+            "epoch": epoch,
+            "routes": _build_delivery_calendar(now, CALENDAR_MAX_DATES, index),
+            "generated_at": now,
+        }
+        _calendar_cache = cache
+    return {
+        "reference_date": now.strftime('%Y-%m-%d'),
+        "generated_at": cache["generated_at"],
+        "n": n,
+        "routes": [{**r, "dates": r["dates"][:n]} for r in cache["routes"]],
+    }
+
+
+_install_routes(ROUTES_14_DAYS)
+
+
 # Define Models
 class Product(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -436,6 +995,8 @@ class Product(BaseModel):
     brand: Optional[str] = None
     available: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    # Versiones reducidas de la imagen: {"thumb": {"jpg": url, "webp": url}, "detail": {...}}
+    image_variants: Optional[Dict[str, Dict[str, str]]] = None
 
 
 class CartItem(BaseModel):
@@ -473,6 +1034,23 @@ class Order(BaseModel):
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 
+class OrderSummary(BaseModel):
+    """Vista ligera de un pedido para listados (GET /api/orders?view=summary)."""
+    id: str
+    customer_name: str
+    customer_email: str
+    delivery_city: Optional[str] = None
+    status: str = "pendiente"
+    delivery_date: Optional[str] = None
+    delivery_day: Optional[str] = None
+    created_at: datetime
+
+
+class DeliveryDateBatchRequest(BaseModel):
+    cities: List[str] = Field(..., max_length=5000)
+    reference_date: Optional[datetime] = None  # "YYYY-MM-DD" o "YYYY-MM-DDTHH:MM"; por defecto ahora
+
+
 EMAIL_INFO = "info@aqualan.es"
 
 
@@ -488,45 +1066,213 @@ class OfferRequestForm(BaseModel):
     mensaje: Optional[str] = None
 
 
-def _send_email_wp(to: str, subject: str, html: str) -> bool:
-    """Envía un email via el endpoint REST de WordPress (usa WP Mail SMTP con info@aqualan.es)."""
-    try:
-        resp = http_requests.post(
-            WP_MAIL_ENDPOINT,
-            json={"to": to, "subject": subject, "html": html},
-            headers={"X-API-Key": WP_MAIL_API_KEY, "Content-Type": "application/json", "User-Agent": "AQUALAN-App/1.0"},
-            timeout=15,
+# Cliente HTTP asíncrono compartido para WP Mail y Resend: conexiones keep-alive reutilizadas (sin un
+# handshake TLS por email) y como mucho EMAIL_MAX_CONCURRENCY envíos a la vez. Si no hay hueco en
+# EMAIL_QUEUE_TIMEOUT segundos se lanza EmailBackpressure en vez de acumular peticiones en cola.
+RESEND_API_URL = "https://api.resend.com/emails"
+EMAIL_HTTP_TIMEOUT = float(os.environ.get("EMAIL_HTTP_TIMEOUT", "15"))
+EMAIL_MAX_CONCURRENCY = int(os.environ.get("EMAIL_MAX_CONCURRENCY", "10"))
+EMAIL_QUEUE_TIMEOUT = float(os.environ.get("EMAIL_QUEUE_TIMEOUT", "5"))
+_email_http = None
+_email_slots: Optional[asyncio.Semaphore] = None
+
+
+class EmailBackpressure(Exception):
+    """Todos los huecos de envío están ocupados: reintentar más tarde."""
+
+
+def _get_email_http():
+    global _email_http, _email_slots
+    if _email_http is None:
+        import httpx
+
+        _email_http = httpx.AsyncClient(
+            timeout=EMAIL_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=EMAIL_MAX_CONCURRENCY, max_keepalive_connections=EMAIL_MAX_CONCURRENCY),
+            headers={"User-Agent": "AQUALAN-App/1.0"},
         )
-        if resp.ok and resp.json().get("success"):
-            return True
-        logger.error("WP Mail endpoint error: status=%s body=%s", resp.status_code, resp.text)
-        return False
-    except Exception as e:
-        logger.exception("WP Mail endpoint falló: %s", e)
-        return False
+        _email_slots = asyncio.Semaphore(EMAIL_MAX_CONCURRENCY)
+    return _email_http
+
+
+async def _close_email_http() -> None:
+    global _email_http, _email_slots
+    if _email_http is not None:
+        await _email_http.aclose()
+        _email_http = None
+        _email_slots = None
+
 
+@contextlib.asynccontextmanager
+async def _email_slot():
+    try:
+        await asyncio.wait_for(_email_slots.acquire(), EMAIL_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise EmailBackpressure(f"{EMAIL_MAX_CONCURRENCY} envíos en curso; sin hueco en {EMAIL_QUEUE_TIMEOUT:g}s")
+    try:
+        yield
+    finally:
+        _email_slots.release()
 
-def _send_email_resend(to: str, subject: str, html: str, from_email: Optional[str] = None) -> bool:
+
+async def _send_email_wp(to: str, subject: str, html: str) -> bool:
+    """Envía un email via el endpoint REST de WordPress (usa WP Mail SMTP con info@aqualan.es)."""
+    http = _get_email_http()
+    async with _email_slot():
+        try:
+            resp = await http.post(
+                WP_MAIL_ENDPOINT,
+                json={"to": to, "subject": subject, "html": html},
+                headers={"X-API-Key": WP_MAIL_API_KEY},
+            )
+            if resp.is_success and resp.json().get("success"):
+                return True
+            logger.error("WP Mail endpoint error: status=%s body=%s", resp.status_code, resp.text)
+            return False
+        except Exception as e:
+            logger.exception("WP Mail endpoint falló: %s", e)
+            return False
+
+
+async def _send_email_resend(to: str, subject: str, html: str, from_email: Optional[str] = None) -> bool:
     """Envía un email usando la API de Resend (HTTPS). Fallback si WP Mail no está disponible."""
-    if not RESEND_API_KEY or not resend:
+    if not RESEND_API_KEY:
         return False
-    try:
-        resend.api_key = RESEND_API_KEY
-        params = {
-            "from": from_email or EMAIL_FROM_RESEND,
-            "to": [to],
-            "subject": subject,
-            "html": html,
-        }
-        resend.Emails.send(params)
-        return True
-    except Exception as e:
-        logger.exception("Resend send failed: %s", e)
+    http = _get_email_http()
+    async with _email_slot():
+        try:
+            resp = await http.post(
+                RESEND_API_URL,
+                json={"from": from_email or EMAIL_FROM_RESEND, "to": [to], "subject": subject, "html": html},
+                headers={"Authorization": f"Bearer {RESEND_API_KEY}"},
+            )
+            if resp.is_success:
+                return True
+            logger.error("Resend error: status=%s body=%s", resp.status_code, resp.text)
+            return False
+        except Exception as e:
+            logger.exception("Resend send failed: %s", e)
+            return False
+
+
+# Circuito por proveedor: tras EMAIL_BREAKER_FAILURES fallos seguidos el proveedor se salta (sin esperar su
+# timeout) durante EMAIL_BREAKER_COOLDOWN segundos; después se deja pasar un único envío de prueba
+# (half-open) que lo cierra si funciona o lo reabre si falla.
+# EMAIL_HEDGE_AFTER > 0 activa el envío "hedged": si el proveedor principal no ha contestado en ese tiempo
+# se lanza también el siguiente y gana el primero que entregue. Puede duplicar algún email si el
+# principal acaba entregando tarde, por eso está desactivado por defecto.
+EMAIL_BREAKER_FAILURES = int(os.environ.get("EMAIL_BREAKER_FAILURES", "3"))
+EMAIL_BREAKER_COOLDOWN = float(os.environ.get("EMAIL_BREAKER_COOLDOWN", "60"))
+EMAIL_HEDGE_AFTER = float(os.environ.get("EMAIL_HEDGE_AFTER", "0"))
+
+
+class _ProviderBreaker:
+    def __init__(self, name: str, send):
+        self.name = name
+        self.send = send
+        self.state = "closed"  # closed | open | half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.last_latency_ms: Optional[float] = None
+        self.stats = {"sent": 0, "failed": 0, "skipped": 0}
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= EMAIL_BREAKER_COOLDOWN:
+            self.state = "half_open"
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        self.stats["skipped"] += 1
         return False
 
+    def record(self, ok: bool, elapsed: float) -> None:
+        self.probing = False
+        self.last_latency_ms = round(elapsed * 1000, 1)
+        if ok:
+            if self.state != "closed":
+                logger.info("Proveedor de email %s recuperado; circuito cerrado", self.name)
+            self.state, self.failures = "closed", 0
+            self.stats["sent"] += 1
+            return
+        self.failures += 1
+        self.stats["failed"] += 1
+        if self.state == "half_open" or self.failures >= EMAIL_BREAKER_FAILURES:
+            if self.state != "open":
+                logger.warning("Proveedor de email %s: circuito abierto tras %d fallos (reintento en %.0fs)",
+                               self.name, self.failures, EMAIL_BREAKER_COOLDOWN)
+            self.state, self.opened_at = "open", time.monotonic()
+
+    def summary(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures,
+                "last_latency_ms": self.last_latency_ms, **self.stats}
+
+
+_email_breakers = {
+    "wp_mail": _ProviderBreaker("wp_mail", _send_email_wp),
+    "resend": _ProviderBreaker("resend", _send_email_resend),
+}
+
+
+def _email_providers() -> List[_ProviderBreaker]:
+    """Proveedores configurados, en orden de preferencia."""
+    providers = []
+    if WP_MAIL_ENDPOINT:
+        providers.append(_email_breakers["wp_mail"])
+    if RESEND_API_KEY:
+        providers.append(_email_breakers["resend"])
+    return providers
+
+
+async def _attempt_provider(breaker: _ProviderBreaker, to: str, subject: str, html: str) -> bool:
+    t0 = time.perf_counter()
+    try:
+        ok = await breaker.send(to, subject, html)
+    except BaseException:
+        # Backpressure o cancelación (perdió la carrera hedged): no dice nada de la salud del proveedor
+        breaker.probing = False
+        raise
+    elapsed = time.perf_counter() - t0
+    breaker.record(ok, elapsed)
+    _EMAIL_LATENCY.observe(elapsed, breaker.name, "ok" if ok else "error")
+    return ok
+
 
+async def _deliver_email(to: str, subject: str, html: str) -> tuple:
+    """Envía por el primer proveedor disponible (WP Mail, después Resend). Devuelve (ok, proveedor)."""
+    remaining = _email_providers()
+    pending = {}
 
-def _send_offer_request_email(data: OfferRequestForm) -> bool:
+    def launch_next() -> None:
+        while remaining:
+            breaker = remaining.pop(0)
+            if breaker.allow():
+                pending[asyncio.create_task(_attempt_provider(breaker, to, subject, html))] = breaker
+                return
+
+    launch_next()
+    try:
+        while pending:
+            hedge = EMAIL_HEDGE_AFTER if EMAIL_HEDGE_AFTER > 0 and remaining else None
+            done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch_next()  # el principal tarda: se lanza el siguiente en paralelo
+                continue
+            for task in done:
+                breaker = pending.pop(task)
+                if task.result():
+                    return True, breaker.name
+            if not pending:
+                launch_next()
+    finally:
+        for task in pending:
+            task.cancel()
+    return False, None
+
+
+async def _send_offer_request_email(data: OfferRequestForm) -> bool:
     """Envía a info@aqualan.es la solicitud de oferta con formato claro."""
     provincia_display = data.otra_provincia.strip() if data.ubicacion == "otra" and data.otra_provincia else data.ubicacion.replace("-", " ").title()
     productos_labels = {
@@ -570,15 +1316,10 @@ def _send_offer_request_email(data: OfferRequestForm) -> bool:
     """
     subject = f'Oferta solicitada: {data.empresa} - {data.nombre}'
 
-    # 1) WordPress WP Mail SMTP (info@aqualan.es)
-    if _send_email_wp(EMAIL_INFO, subject, html_content):
-        logger.info("Email de oferta enviado via WP Mail: %s - %s", data.empresa, data.email)
-        return True
-    logger.warning("WP Mail falló al enviar oferta. Intentando Resend.")
-
-    # 2) Fallback a Resend
-    if _send_email_resend(EMAIL_INFO, subject, html_content):
-        logger.info("Email de oferta enviado via Resend: %s - %s", data.empresa, data.email)
+    # WordPress WP Mail SMTP (info@aqualan.es) y Resend como fallback, saltando el que tenga el circuito abierto
+    ok, provider = await _deliver_email(EMAIL_INFO, subject, html_content)
+    if ok:
+        logger.info("Email de oferta enviado via %s: %s - %s", provider, data.empresa, data.email)
         return True
 
     logger.warning("Oferta solicitada: ni WP Mail ni Resend funcionaron.")
@@ -652,51 +1393,515 @@ def _build_order_html(order, delivery_message: str, to_customer: bool) -> tuple[
     return subject, html
 
 
-async def send_order_email(order: Order, delivery_info: dict, to_customer: bool = False):
-    """Envía email del pedido vía WP Mail (info@aqualan.es) o Resend como fallback."""
+# Outbox de emails: los emails de pedido se guardan (MongoDB, o SQLite local si no hay BD o falla) y un
+# worker en segundo plano los entrega con reintentos y backoff exponencial. Al apagar se vacía la cola.
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get("OUTBOX_RETRY_BASE_SECONDS", "30"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.environ.get("OUTBOX_RETRY_MAX_SECONDS", "3600"))
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "5"))
+OUTBOX_DRAIN_TIMEOUT = float(os.environ.get("OUTBOX_DRAIN_TIMEOUT", "20"))
+# Un mensaje en "sending" más tiempo que esto (p. ej. el proceso murió enviándolo) se vuelve a intentar
+OUTBOX_LOCK_TIMEOUT = timedelta(seconds=float(os.environ.get("OUTBOX_LOCK_TIMEOUT", "300")))
+OUTBOX_SQLITE_PATH = Path(os.environ.get("OUTBOX_SQLITE_PATH", str(ROOT_DIR / ".cache" / "outbox.sqlite3")))
+
+
+def _new_outbox_message(to: str, subject: str, html: str, kind: str,
+                        order_id: Optional[str] = None, copy_to: Optional[str] = None) -> dict:
+    now = datetime.utcnow()
+    return {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "order_id": order_id,
+        "to": to,
+        "copy_to": copy_to,  # tras entregarse, se encola una copia a esta dirección
+        "subject": subject,
+        "html": html,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "locked_at": None,
+        "last_error": None,
+        "provider": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+class _MongoOutbox:
+    name = "mongo"
+
+    async def insert(self, messages: List[dict]) -> None:
+        await db.email_outbox.insert_many([dict(m) for m in messages])
+
+    async def claim_due(self, now: datetime, limit: int) -> List[dict]:
+        claimed = []
+        query = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "locked_at": {"$lt": now - OUTBOX_LOCK_TIMEOUT}},
+        ]}
+        for _ in range(limit):
+            msg = await db.email_outbox.find_one_and_update(
+                query,
+                {"$set": {"status": "sending", "locked_at": now}},
+                sort=[("next_attempt_at", 1)],
+                projection={"_id": 0},
+            )
+            if msg is None:
+                break
+            claimed.append(msg)
+        return claimed
+
+    async def update(self, msg_id: str, fields: dict) -> None:
+        await db.email_outbox.update_one({"id": msg_id}, {"$set": fields})
+
+    async def counts(self) -> dict:
+        rows = await db.email_outbox.aggregate([{"$group": {"_id": "$status", "n": {"$sum": 1}}}]).to_list(None)
+        return {r["_id"]: r["n"] for r in rows}
+
+
+class _SqliteOutbox:
+    """Sustituto local del outbox cuando MongoDB no está disponible. Las llamadas van a un hilo."""
+    name = "sqlite"
+    _columns = ("id", "kind", "order_id", "to", "copy_to", "subject", "html", "status", "attempts",
+                "next_attempt_at", "locked_at", "last_error", "provider", "created_at", "updated_at")
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            import sqlite3
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS email_outbox ("
+                "id TEXT PRIMARY KEY, kind TEXT, order_id TEXT, \"to\" TEXT, copy_to TEXT, subject TEXT, html TEXT, "
+                "status TEXT, attempts INTEGER, next_attempt_at TEXT, locked_at TEXT, last_error TEXT, "
+                "provider TEXT, created_at TEXT, updated_at TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS email_outbox_due ON email_outbox (status, next_attempt_at)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _to_db(value):
+        return value.isoformat() if isinstance(value, datetime) else value
+
+    @staticmethod
+    def _from_row(row) -> dict:
+        msg = dict(row)
+        for k in ("next_attempt_at", "locked_at", "created_at", "updated_at"):
+            if msg.get(k):
+                msg[k] = datetime.fromisoformat(msg[k])
+        return msg
+
+    def _insert(self, messages: List[dict]) -> None:
+        cols = ", ".join(f'"{c}"' for c in self._columns)
+        marks = ", ".join("?" for _ in self._columns)
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            conn.executemany(
+                f"INSERT INTO email_outbox ({cols}) VALUES ({marks})",
+                [tuple(self._to_db(m.get(c)) for c in self._columns) for m in messages],
+            )
+            conn.execute("COMMIT")
+
+    def _claim_due(self, now: datetime, limit: int) -> List[dict]:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT * FROM email_outbox WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "OR (status = 'sending' AND locked_at < ?) ORDER BY next_attempt_at LIMIT ?",
+                (now.isoformat(), (now - OUTBOX_LOCK_TIMEOUT).isoformat(), limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE email_outbox SET status = 'sending', locked_at = ? WHERE id = ?",
+                [(now.isoformat(), r["id"]) for r in rows],
+            )
+            conn.execute("COMMIT")
+        return [{**self._from_row(r), "status": "sending", "locked_at": now} for r in rows]
+
+    def _update(self, msg_id: str, fields: dict) -> None:
+        sets = ", ".join(f'"{k}" = ?' for k in fields)
+        with self._lock:
+            self._connection().execute(
+                f"UPDATE email_outbox SET {sets} WHERE id = ?",
+                (*[self._to_db(v) for v in fields.values()], msg_id),
+            )
+
+    def _counts(self) -> dict:
+        with self._lock:
+            rows = self._connection().execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall()
+        return {r[0]: r[1] for r in rows}
+
+    async def insert(self, messages: List[dict]) -> None:
+        await asyncio.to_thread(self._insert, messages)
+
+    async def claim_due(self, now: datetime, limit: int) -> List[dict]:
+        return await asyncio.to_thread(self._claim_due, now, limit)
+
+    async def update(self, msg_id: str, fields: dict) -> None:
+        await asyncio.to_thread(self._update, msg_id, fields)
+
+    async def counts(self) -> dict:
+        return await asyncio.to_thread(self._counts)
+
+
+_mongo_outbox = _MongoOutbox()
+_sqlite_outbox = _SqliteOutbox(OUTBOX_SQLITE_PATH)
+_outbox_wakeup: Optional[asyncio.Event] = None
+_outbox_task: Optional[asyncio.Task] = None
+_outbox_stopping = False
+_outbox_stats = {"sent": 0, "retried": 0, "failed": 0, "errors": 0}
+# Estados que no se pudieron guardar (p. ej. AutoReconnect tras enviar): (almacén, id) -> (almacén, campos).
+# Se reintentan antes de reclamar más mensajes, para no reenviar un email ya entregado.
+_outbox_unsaved: Dict[tuple, tuple] = {}
+
+
+def _outbox_stores() -> list:
+    # SQLite siempre: puede tener mensajes encolados durante una caída de MongoDB
+    return [_mongo_outbox, _sqlite_outbox] if db_available() else [_sqlite_outbox]
+
+
+async def enqueue_emails(messages: List[dict]) -> str:
+    """Guarda los mensajes en el outbox y despierta al worker. Devuelve el almacén usado."""
+    store = _sqlite_outbox
+    if db_available():
+        try:
+            await _mongo_outbox.insert(messages)
+            store = _mongo_outbox
+        except Exception as e:
+            _db_failed(e)
+            logger.warning("Outbox en MongoDB no disponible (%s). Usando SQLite local.", e)
+    if store is _sqlite_outbox:
+        _FALLBACKS.inc("email_outbox")
+        await _sqlite_outbox.insert(messages)
+    if _outbox_wakeup is not None:
+        _outbox_wakeup.set()
+    return store.name
+
+
+async def enqueue_order_emails(order: Order, delivery_info: dict) -> str:
+    """Encola la confirmación al cliente y, salvo en modo digest, el email a la empresa y la copia de la
+    confirmación: en ese modo la empresa solo recibe el resumen por ruta."""
+    delivery_message = delivery_info.get('message', 'Fecha por confirmar')
+    per_order = ORDER_EMAIL_MODE != "digest"
+    messages = []
+    if per_order:
+        subject, html = _build_order_html(order, delivery_message, False)
+        messages.append(_new_outbox_message(EMAIL_TO, subject, html, "pedido_empresa", order.id))
+    subject, html = _build_order_html(order, delivery_message, True)
+    messages.append(_new_outbox_message(order.customer_email, subject, html, "pedido_cliente", order.id,
+                                        copy_to=EMAIL_TO if per_order else None))
+    return await enqueue_emails(messages)
+
+
+async def _outbox_save(store, msg_id: str, fields: dict) -> None:
     try:
-        delivery_message = delivery_info.get('message', 'Fecha por confirmar')
-        subject, html = _build_order_html(order, delivery_message, to_customer)
-        dest = order.customer_email if to_customer else EMAIL_TO
-        ok = await asyncio.to_thread(_send_email_wp, dest, subject, html)
-        if not ok:
-            ok = await asyncio.to_thread(_send_email_resend, dest, subject, html)
-        if to_customer and ok:
-            # Copia a la empresa
-            await asyncio.to_thread(_send_email_wp, EMAIL_TO, subject, html)
-        if ok:
-            logger.info("Email enviado para pedido %s (to_customer=%s)", order.id, to_customer)
-        else:
-            logger.warning("No se pudo enviar email para pedido %s", order.id)
-        return ok
+        await store.update(msg_id, fields)
     except Exception as e:
-        logger.exception("Error enviando email pedido %s: %s", order.id, e)
-        return False
+        _db_failed(e)
+        _outbox_unsaved[(store.name, msg_id)] = (store, fields)
+        logger.warning("No se pudo guardar el estado del email %s (%s): %s; se reintenta", msg_id, store.name, e)
 
 
-def _send_order_email_sync(order: Order, delivery_info: dict, to_customer: bool) -> None:
-    """Envía el email del pedido vía WP Mail (info@aqualan.es) o Resend como fallback."""
+async def _outbox_flush_unsaved() -> set:
+    """Guarda los estados pendientes. Devuelve los almacenes que siguen fallando (no se reclama de ellos)."""
+    failing = set()
+    for key, (store, fields) in list(_outbox_unsaved.items()):
+        if store.name in failing:
+            continue
+        try:
+            await store.update(key[1], fields)
+        except Exception as e:
+            _db_failed(e)
+            failing.add(store.name)
+            continue
+        del _outbox_unsaved[key]
+    return failing
+
+
+async def _process_outbox_message(store, msg: dict) -> None:
     try:
-        delivery_message = delivery_info.get('message', 'Fecha por confirmar')
-        subject, html = _build_order_html(order, delivery_message, to_customer)
-        dest = order.customer_email if to_customer else EMAIL_TO
+        ok, provider = await _deliver_email(msg["to"], msg["subject"], msg["html"])
+        error = None if ok else "Ni WP Mail ni Resend funcionaron"
+    except EmailBackpressure as e:
+        # Pool de envío lleno: se devuelve a la cola sin gastar un intento
+        await _outbox_save(store, msg["id"], {"status": "pending", "locked_at": None, "last_error": str(e),
+                                              "next_attempt_at": datetime.utcnow() + timedelta(seconds=OUTBOX_POLL_SECONDS)})
+        return
+    except Exception as e:
+        ok, provider, error = False, None, str(e)
+    now = datetime.utcnow()
+    attempts = (msg.get("attempts") or 0) + 1
+    if ok:
+        _outbox_stats["sent"] += 1
+        await _outbox_save(store, msg["id"], {"status": "sent", "attempts": attempts, "provider": provider,
+                                              "last_error": None, "locked_at": None, "updated_at": now})
+        logger.info("Email %s enviado via %s (pedido %s)", msg["kind"], provider, msg.get("order_id"))
+        if msg.get("copy_to"):
+            await enqueue_emails([_new_outbox_message(msg["copy_to"], msg["subject"], msg["html"],
+                                                      f"{msg['kind']}_copia", msg.get("order_id"))])
+    elif attempts >= OUTBOX_MAX_ATTEMPTS:
+        _outbox_stats["failed"] += 1
+        await _outbox_save(store, msg["id"], {"status": "failed", "attempts": attempts, "last_error": error,
+                                              "locked_at": None, "updated_at": now})
+        logger.error("Email %s a %s descartado tras %d intentos: %s", msg["kind"], msg["to"], attempts, error)
+    else:
+        _outbox_stats["retried"] += 1
+        delay = min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS)
+        delay *= 1 + random.random() * 0.1
+        await _outbox_save(store, msg["id"], {"status": "pending", "attempts": attempts, "last_error": error,
+                                              "locked_at": None, "updated_at": now,
+                                              "next_attempt_at": now + timedelta(seconds=delay)})
+        logger.warning("Email %s a %s falló (intento %d), reintento en %.0fs", msg["kind"], msg["to"], attempts, delay)
+
+
+async def _outbox_run_once() -> int:
+    """Reclama los mensajes vencidos de cada almacén y los envía todos a la vez (p. ej. empresa y cliente)."""
+    failing = await _outbox_flush_unsaved()
+    claimed = []
+    for store in _outbox_stores():
+        if store.name in failing:
+            continue
+        try:
+            batch = await store.claim_due(datetime.utcnow(), OUTBOX_BATCH_SIZE)
+        except Exception as e:
+            _db_failed(e)
+            logger.warning("No se pudo leer el outbox (%s): %s", store.name, e)
+            continue
+        claimed.extend((store, m) for m in batch if (store.name, m["id"]) not in _outbox_unsaved)
+    results = await asyncio.gather(*(_process_outbox_message(store, m) for store, m in claimed),
+                                   return_exceptions=True)
+    for (store, msg), result in zip(claimed, results):
+        if isinstance(result, Exception):
+            _outbox_stats["errors"] += 1
+            logger.error("Error procesando el email %s (%s): %s", msg["id"], store.name, result)
+    return len(claimed)
+
+
+async def _outbox_worker() -> None:
+    """Entrega los emails pendientes; al pedir la parada vacía lo que quede vencido y termina."""
+    while True:
+        try:
+            processed = await _outbox_run_once()
+        except Exception as e:
+            # Un fallo inesperado no debe parar el worker: se registra y se vuelve a intentar tras la espera
+            _outbox_stats["errors"] += 1
+            logger.exception("Error en el worker del outbox: %s", e)
+            processed = 0
+        if processed:
+            continue
+        if _outbox_stopping:
+            return
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _outbox_wakeup.clear()
 
-        # 1) WordPress WP Mail SMTP
-        ok = _send_email_wp(dest, subject, html)
-        if not ok:
-            # 2) Fallback Resend
-            ok = _send_email_resend(dest, subject, html)
 
-        if to_customer and ok:
-            # Copia a la empresa
-            _send_email_wp(EMAIL_TO, subject, html) or _send_email_resend(EMAIL_TO, subject, html)
+def start_outbox_worker() -> None:
+    global _outbox_wakeup, _outbox_task, _outbox_stopping
+    _outbox_wakeup = asyncio.Event()
+    _outbox_stopping = False
+    _outbox_task = asyncio.create_task(_outbox_worker())
 
-        if ok:
-            logger.info("Email de pedido enviado: %s (to_customer=%s)", order.id, to_customer)
-        else:
-            logger.warning("Email de pedido %s: ni WP Mail ni Resend funcionaron.", order.id)
-    except Exception as e:
-        logger.exception("Error enviando email de pedido (background): %s", e)
+
+async def stop_outbox_worker() -> None:
+    """Pide al worker que vacíe la cola y espera como mucho OUTBOX_DRAIN_TIMEOUT segundos."""
+    global _outbox_stopping
+    if _outbox_task is None:
+        return
+    _outbox_stopping = True
+    _outbox_wakeup.set()
+    try:
+        await asyncio.wait_for(_outbox_task, OUTBOX_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Outbox no vaciado en %.0fs; los pendientes se enviarán en el próximo arranque", OUTBOX_DRAIN_TIMEOUT)
+
+
+# Resumen de reparto para la oficina: a las horas de ORDER_DIGEST_TIMES (hora local) se agrupan los pedidos
+# pendientes aún no resumidos por fecha de entrega y ruta de reparto (DELIVERY_ROUTE_GROUPS), y se encola un
+# email por grupo con las cantidades sumadas por producto. ORDER_EMAIL_MODE: "per_order" (un email por
+# pedido, como siempre), "digest" (solo el resumen) o "both". La confirmación al cliente se envía siempre por
+# pedido (en modo digest, sin copia a la empresa).
+ORDER_EMAIL_MODE = os.environ.get("ORDER_EMAIL_MODE", "per_order").strip().lower()
+if ORDER_EMAIL_MODE not in ("per_order", "digest", "both"):
+    logger.warning("ORDER_EMAIL_MODE=%s no válido; se usa per_order", ORDER_EMAIL_MODE)
+    ORDER_EMAIL_MODE = "per_order"
+ORDER_DIGEST_TIMES = os.environ.get("ORDER_DIGEST_TIMES", "09:30,17:00")
+# Los pedidos más antiguos que esto no entran en el resumen (p. ej. al activar el modo digest)
+ORDER_DIGEST_LOOKBACK = timedelta(days=float(os.environ.get("ORDER_DIGEST_LOOKBACK_DAYS", "7")))
+_digest_stats = {"last_run": None, "digests": 0, "orders": 0}
+
+
+def _parse_digest_times(spec: str) -> List[tuple]:
+    times = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            t = datetime.strptime(part, "%H:%M")
+            times.add((t.hour, t.minute))
+        except ValueError:
+            logger.warning("ORDER_DIGEST_TIMES: hora no válida %r (formato HH:MM)", part)
+    return sorted(times)
+
+
+def _next_digest_at(now: datetime, times: List[tuple]) -> datetime:
+    for day in range(2):
+        base = now.date() + timedelta(days=day)
+        for hour, minute in times:
+            at = datetime(base.year, base.month, base.day, hour, minute)
+            if at > now:
+                return at
+    raise ValueError("ORDER_DIGEST_TIMES vacío")
+
+
+def _order_route(order: dict) -> str:
+    """Ruta de reparto del pedido (p. ej. "Getxo-Leioa" para Getxo, Leioa y Algorta)."""
+    entry = _resolve_route(order.get("delivery_city") or "")
+    if entry is not None:
+        return entry["route"].title()
+    return (order.get("delivery_city") or "").strip().title() or "Sin ruta"
+
+
+def _build_digest_html(delivery_date: Optional[str], route: str, orders: List[dict]) -> tuple[str, str]:
+    """Genera el HTML y subject del resumen de una ruta-día con las cantidades totales por producto."""
+    if delivery_date:
+        d = datetime.strptime(delivery_date, '%Y-%m-%d')
+        date_text = f"{DAY_NAMES[d.weekday()]} {d.strftime('%d/%m/%Y')}"
+    else:
+        date_text = "Fecha por confirmar"
+    totals: Dict[tuple, int] = {}
+    for order in orders:
+        for item in order.get("items", []):
+            key = (item["product_name"], item["unit"])
+            totals[key] = totals.get(key, 0) + item["quantity"]
+    totals_html = "".join(
+        f"<tr><td style='padding:10px;border-bottom:1px solid #eee;'>{name}</td>"
+        f"<td style='padding:10px;border-bottom:1px solid #eee;text-align:center;'><strong>{qty}</strong></td>"
+        f"<td style='padding:10px;border-bottom:1px solid #eee;'>{unit}</td></tr>"
+        for (name, unit), qty in sorted(totals.items())
+    )
+    orders_html = "".join(
+        f"<tr><td style='padding:8px;border-bottom:1px solid #eee;vertical-align:top;'>#{o['id'][:8].upper()}</td>"
+        f"<td style='padding:8px;border-bottom:1px solid #eee;vertical-align:top;'><strong>{o['customer_name']}</strong><br>"
+        f"{o['customer_phone']}<br>{o['delivery_address']}, {o.get('delivery_city') or ''}</td>"
+        f"<td style='padding:8px;border-bottom:1px solid #eee;vertical-align:top;'>"
+        + "<br>".join(f"{i['quantity']} × {i['product_name']} ({i['unit']})" for i in o.get("items", []))
+        + (f"<br><em>📝 {o['notes']}</em>" if o.get("notes") else "")
+        + "</td></tr>"
+        for o in sorted(orders, key=lambda o: o["created_at"])
+    )
+    localities = ", ".join(sorted({(o.get("delivery_city") or "").strip().title() for o in orders} - {""}))
+    html = f"""
+    <html><body style="font-family:Arial,sans-serif;max-width:600px;margin:0 auto;">
+        <div style="background-color:#0077B6;color:white;padding:20px;text-align:center;">
+            <h1 style="margin:0;">AQUALAN</h1>
+            <p style="margin:5px 0 0 0;">Resumen de Reparto</p>
+        </div>
+        <div style="padding:20px;">
+            <div style="background-color:#e8f4f8;padding:15px;border-radius:8px;margin-bottom:20px;">
+                <h3 style="color:#023E8A;margin-top:0;">🚚 {route}</h3>
+                <p style="font-size:18px;font-weight:bold;color:#0077B6;margin-bottom:0;">{date_text} — {len(orders)} pedido(s)</p>
+                <p style="margin-bottom:0;color:#333;">Localidades: {localities or "sin indicar"}</p>
+            </div>
+            <h3 style="color:#023E8A;">📦 Total a cargar</h3>
+            <table style="width:100%;border-collapse:collapse;background-color:#f9f9f9;">
+                <thead><tr style="background-color:#0077B6;color:white;">
+                    <th style="padding:10px;text-align:left;">Producto</th>
+                    <th style="padding:10px;text-align:center;">Cantidad</th>
+                    <th style="padding:10px;text-align:left;">Unidad</th>
+                </tr></thead>
+                <tbody>{totals_html}</tbody>
+            </table>
+            <h3 style="color:#023E8A;">👤 Pedidos</h3>
+            <table style="width:100%;border-collapse:collapse;font-size:14px;">{orders_html}</table>
+        </div>
+        <div style="background-color:#f5f5f5;padding:15px;text-align:center;font-size:12px;color:#666;">
+            <p>Resumen generado automáticamente desde la App de Pedidos de AQUALAN</p>
+        </div>
+    </body></html>
+    """
+    subject = f'🚚 Reparto {route} - {date_text} ({len(orders)} pedidos)'
+    return subject, html
+
+
+async def _undigested_orders(since: datetime) -> List[dict]:
+    orders = {}
+    if db_available():
+        try:
+            query = {"status": "pendiente", "digest_sent_at": None, "created_at": {"$gte": since}}
+            async for doc in db.orders.find(query, {"_id": 0}):
+                orders[doc["id"]] = doc
+        except Exception as e:
+            _db_failed(e)
+            logger.warning("No se pudieron leer los pedidos para el resumen: %s", e)
+    # Los pedidos en memoria (sin BD o porque falló el insert) también entran
+    for doc in _orders_in_memory.since(since):
+        if doc.get("status") == "pendiente" and not doc.get("digest_sent_at"):
+            orders.setdefault(doc["id"], doc)
+    return list(orders.values())
+
+
+async def _mark_orders_digested(ids: List[str], now: datetime) -> None:
+    if db_available():
+        try:
+            await db.orders.update_many({"id": {"$in": ids}}, {"$set": {"digest_sent_at": now}})
+        except Exception as e:
+            _db_failed(e)
+            logger.warning("No se pudieron marcar %d pedidos como resumidos (pueden repetirse): %s", len(ids), e)
+    for order_id in ids:
+        doc = _orders_in_memory.get(order_id)
+        if doc is not None:
+            doc["digest_sent_at"] = now
+
+
+async def send_route_digests() -> dict:
+    """Encola un resumen por (fecha de entrega, ruta) con los pedidos pendientes aún no resumidos."""
+    now = datetime.utcnow()
+    orders = await _undigested_orders(now - ORDER_DIGEST_LOOKBACK)
+    groups: Dict[tuple, List[dict]] = {}
+    for order in orders:
+        groups.setdefault((order.get("delivery_date"), _order_route(order)), []).append(order)
+    messages = []
+    for (delivery_date, route), group in sorted(groups.items(), key=lambda kv: (kv[0][0] or "9999", kv[0][1])):
+        subject, html = _build_digest_html(delivery_date, route, group)
+        messages.append(_new_outbox_message(EMAIL_TO, subject, html, "resumen_ruta"))
+    if messages:
+        await enqueue_emails(messages)
+        await _mark_orders_digested([o["id"] for o in orders], now)
+        logger.info("Resumen de reparto: %d email(s) con %d pedido(s)", len(messages), len(orders))
+    _digest_stats["last_run"] = now
+    _digest_stats["digests"] += len(messages)
+    _digest_stats["orders"] += len(orders)
+    return {"digests": len(messages), "orders": len(orders)}
+
+
+async def _digest_worker() -> None:
+    """Tarea de fondo: envía los resúmenes de reparto a las horas de ORDER_DIGEST_TIMES."""
+    times = _parse_digest_times(ORDER_DIGEST_TIMES)
+    if not times:
+        logger.warning("ORDER_EMAIL_MODE=%s sin horas válidas en ORDER_DIGEST_TIMES: no se enviarán resúmenes", ORDER_EMAIL_MODE)
+        return
+    while True:
+        now = datetime.now()
+        await asyncio.sleep((_next_digest_at(now, times) - now).total_seconds())
+        try:
+            await send_route_digests()
+        except Exception as e:
+            logger.exception("Error generando el resumen de reparto: %s", e)
 
 
 # Productos definitivos (imágenes se cambian en GUIA_IMAGENES_PRODUCTOS.md)
@@ -899,20 +2104,340 @@ for _p in SEED_PRODUCTS:
     _p["image_url"] = f"{_STATIC_BASE}/static/products/{_p['id']}.jpg"
 
 
+# Derivados de imágenes de producto: miniatura y detalle en JPEG y WebP, generados con Pillow en
+# static/products/derived/ y cacheados por hash de la imagen original. El manifiesto va en .cache/, fuera
+# de lo que se sirve en /static.
+STATIC_DIR = ROOT_DIR / "static"
+PRODUCT_IMAGES_DIR = STATIC_DIR / "products"
+PRODUCT_IMAGES_DERIVED_DIR = PRODUCT_IMAGES_DIR / "derived"
+PRODUCT_IMAGES_MANIFEST = ROOT_DIR / ".cache" / "product-images.json"
+_LEGACY_IMAGE_MANIFEST = PRODUCT_IMAGES_DERIVED_DIR / "manifest.json"
+IMAGE_VARIANTS = {"thumb": 240, "detail": 720}  # lado mayor máximo en px (ancho y alto)
+_IMAGE_SOURCE_SUFFIXES = (".jpg", ".jpeg", ".png")
+_image_manifest: dict = {}
+_static_versions: Dict[str, str] = {}  # ruta bajo static/ -> versión (?v=) vigente de ese fichero
+
+
+def _load_image_manifest() -> dict:
+    for path in (PRODUCT_IMAGES_MANIFEST, _LEGACY_IMAGE_MANIFEST):
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+    return {}
+
+
+def _render_image_variants(source: Path, stem: str) -> dict:
+    from PIL import Image, ImageOps
+
+    files = {}
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        for variant, max_px in IMAGE_VARIANTS.items():
+            resized = img.copy()
+            resized.thumbnail((max_px, max_px), Image.LANCZOS)
+            names = {"jpg": f"{stem}-{variant}.jpg", "webp": f"{stem}-{variant}.webp"}
+            resized.save(PRODUCT_IMAGES_DERIVED_DIR / names["jpg"], "JPEG", quality=82, optimize=True, progressive=True)
+            resized.save(PRODUCT_IMAGES_DERIVED_DIR / names["webp"], "WEBP", quality=80, method=4)
+            files[variant] = {**names, "width": resized.width, "height": resized.height}
+    return files
+
+
+def build_product_images(force: bool = False) -> dict:
+    """Genera (o reutiliza) los derivados de cada imagen de static/products/. Solo se procesan las
+    imágenes nuevas o cuyo contenido ha cambiado. Devuelve el manifiesto resultante."""
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logger.warning("Pillow no instalado: no se generan miniaturas ni WebP de productos")
+        _set_image_manifest(_load_image_manifest())
+        return _image_manifest
+    if not PRODUCT_IMAGES_DIR.exists():
+        return _image_manifest
+    PRODUCT_IMAGES_DERIVED_DIR.mkdir(parents=True, exist_ok=True)
+    previous = {} if force else _load_image_manifest()
+    manifest, built = {}, 0
+    for source in sorted(PRODUCT_IMAGES_DIR.iterdir()):
+        if source.suffix.lower() not in _IMAGE_SOURCE_SUFFIXES or not source.is_file():
+            continue
+        stem = source.stem
+        if stem in manifest:
+            continue  # mismo id con .jpg y .png: se queda el primero en orden alfabético
+        st = source.stat()
+        entry = previous.get(stem)
+        if entry and entry.get("variants") != IMAGE_VARIANTS:
+            entry = None  # derivados generados con otros tamaños: se regeneran
+        if entry and entry.get("source") == source.name and entry.get("mtime_ns") == st.st_mtime_ns and entry.get("size") == st.st_size:
+            manifest[stem] = entry
+            continue
+        digest = _file_sha256(source)
+        if entry and entry.get("source") == source.name and entry.get("sha256") == digest and \
+                all((PRODUCT_IMAGES_DERIVED_DIR / f[k]).exists() for f in entry["files"].values() for k in ("jpg", "webp")):
+            manifest[stem] = {**entry, "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+            continue
+        try:
+            files = _render_image_variants(source, stem)
+        except Exception as e:
+            logger.warning("No se pudieron generar derivados de %s: %s", source.name, e)
+            continue
+        manifest[stem] = {"source": source.name, "sha256": digest, "mtime_ns": st.st_mtime_ns, "size": st.st_size,
+                          "variants": IMAGE_VARIANTS, "files": files}
+        built += 1
+    for stem, entry in previous.items():
+        if stem not in manifest:
+            for f in entry.get("files", {}).values():
+                for k in ("jpg", "webp"):
+                    (PRODUCT_IMAGES_DERIVED_DIR / f[k]).unlink(missing_ok=True)
+    PRODUCT_IMAGES_MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+    tmp = PRODUCT_IMAGES_MANIFEST.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, PRODUCT_IMAGES_MANIFEST)
+    for legacy in (_LEGACY_IMAGE_MANIFEST, _LEGACY_IMAGE_MANIFEST.with_name("manifest.json.gz")):
+        legacy.unlink(missing_ok=True)
+    _set_image_manifest(manifest)
+    logger.info("Imágenes de producto: %d generadas, %d reutilizadas", built, len(manifest) - built)
+    return manifest
+
+
+def _image_versions(entry: dict) -> tuple:
+    """Versión del original y de los derivados (estos cambian también si cambian los tamaños)."""
+    variants = json.dumps(entry.get("variants"), sort_keys=True)
+    return entry["sha256"][:12], hashlib.sha256(f"{entry['sha256']}:{variants}".encode()).hexdigest()[:12]
+
+
+def _set_image_manifest(manifest: dict) -> None:
+    global _image_manifest, _static_versions
+    versions = {}
+    for entry in manifest.values():
+        source_version, derived_version = _image_versions(entry)
+        versions[f"products/{entry['source']}"] = source_version
+        for f in entry["files"].values():
+            for k in ("jpg", "webp"):
+                versions[f"products/derived/{f[k]}"] = derived_version
+    _image_manifest, _static_versions = manifest, versions
+
+
+def _product_image_urls(product_id: str) -> tuple:
+    """URL de la imagen original y de sus derivados para un producto (derivados None si no existen)."""
+    entry = _image_manifest.get(product_id)
+    if not entry:
+        return f"{_STATIC_BASE}/static/products/{product_id}.jpg", None
+    # ?v=<hash>: la URL cambia cuando cambia la imagen, así que se puede cachear para siempre
+    base = f"{_STATIC_BASE}/static/products"
+    source_version, derived_version = _image_versions(entry)
+    variants = {
+        variant: {"jpg": f"{base}/derived/{f['jpg']}?v={derived_version}",
+                  "webp": f"{base}/derived/{f['webp']}?v={derived_version}"}
+        for variant, f in entry["files"].items()
+    }
+    return f"{base}/{entry['source']}?v={source_version}", variants
+
+
+# Ficheros estáticos: las URLs versionadas con el hash vigente del manifiesto (?v=hash) se sirven con
+# Cache-Control immutable de un año; el resto, incluidos ?v= antiguos o inventados, con STATIC_MAX_AGE.
+# ETag / Last-Modified y el 304 los gestiona StaticFiles.
+STATIC_MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", "3600"))
+_STATIC_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Solo los tipos de recurso web que se sirven a los clientes (no .json/.txt internos)
+_PRECOMPRESS_SUFFIXES = {".svg", ".css", ".js", ".html"}
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles con cabeceras de caché y ficheros .gz precomprimidos si el cliente acepta gzip."""
+
+    async def get_response(self, path: str, scope) -> Response:
+        response = None
+        request_headers = Headers(scope=scope)
+        if Path(path).suffix in _PRECOMPRESS_SUFFIXES and "gzip" in request_headers.get("accept-encoding", ""):
+            try:
+                response = await super().get_response(path + ".gz", scope)
+                response.headers["Content-Encoding"] = "gzip"
+            except StarletteHTTPException:
+                response = None
+        if response is None:
+            response = await super().get_response(path, scope)
+        if Path(path).suffix in _PRECOMPRESS_SUFFIXES:
+            response.headers["Vary"] = "Accept-Encoding"
+        requested = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("v")
+        current = _static_versions.get(Path(path).as_posix())
+        versioned = current is not None and requested == [current]
+        response.headers["Cache-Control"] = _STATIC_IMMUTABLE_CACHE_CONTROL if versioned else f"public, max-age={STATIC_MAX_AGE}"
+        return response
+
+
+def _precompress_static_assets() -> int:
+    """Genera <fichero>.gz junto a los estáticos comprimibles que no lo tengan o lo tengan desfasado, y borra
+    los .gz de tipos que ya no se precomprimen."""
+    written = 0
+    for path in STATIC_DIR.rglob("*"):
+        if path.suffix == ".gz" and Path(path.stem).suffix not in _PRECOMPRESS_SUFFIXES:
+            path.unlink(missing_ok=True)
+            continue
+        if path.suffix not in _PRECOMPRESS_SUFFIXES or not path.is_file():
+            continue
+        gz_path = path.with_name(path.name + ".gz")
+        if gz_path.exists() and gz_path.stat().st_mtime_ns >= path.stat().st_mtime_ns:
+            continue
+        gz_path.write_bytes(gzip.compress(path.read_bytes(), compresslevel=9))
+        written += 1
+    return written
+
+
+# Vida de las claves Idempotency-Key de POST /api/orders (índice TTL en MongoDB, caducidad en memoria)
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", str(24 * 3600)))
+
+# Índices de MongoDB que necesitan las consultas de la app. Se crean al arrancar (create_index es idempotente
+# si la definición no cambia) y /api/admin/indexes muestra cuáles faltan y cuánto se usa cada uno.
+MONGO_INDEXES: Dict[str, List[IndexModel]] = {
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Historial de un cliente y listado paginado: orden (created_at, id) descendente
+        IndexModel([("customer_email", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                   name="customer_email_created_at_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        # Resumen de reparto: pendientes recientes
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING)], name="status_created_at"),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("category", ASCENDING)], name="category"),
+        IndexModel([("brand", ASCENDING)], name="brand"),
+    ],
+    "email_outbox": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt_at"),
+    ],
+    "idempotency_keys": [
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=IDEMPOTENCY_TTL),
+    ],
+}
+_index_state: dict = {"checked_at": None, "created": [], "missing": {}}
+
+
+def _index_keys(spec) -> tuple:
+    """Claves del índice comparables: 1 y 1.0 son iguales; "text", "hashed" o "2dsphere" se dejan tal cual."""
+    return tuple((k, int(v) if isinstance(v, (int, float)) else v)
+                 for k, v in (spec.items() if isinstance(spec, dict) else spec))
+
+
+def _index_options(spec: dict) -> dict:
+    return {"unique": bool(spec.get("unique", False)), "expireAfterSeconds": spec.get("expireAfterSeconds")}
+
+
+def _index_conflict(doc: dict, info: dict) -> Optional[str]:
+    """None si existe un índice con las claves y opciones declaradas; si no, el motivo (falta, u otras opciones)."""
+    wanted = _index_options(doc)
+    for name, existing in info.items():
+        if _index_keys(existing["key"]) != _index_keys(doc["key"]):
+            continue
+        found = _index_options(existing)
+        if found == wanted:
+            return None
+        return f"existe {name} con las mismas claves y otras opciones: {found} (se esperaba {wanted})"
+    return "no existe"
+
+
+async def ensure_indexes() -> dict:
+    """Crea los índices declarados que falten. Los que no se pueden crear (p. ej. ids duplicados para el
+    índice único, o un índice con las mismas claves y otras opciones) se avisan y quedan como "missing"."""
+    if not db_available():
+        return _index_state
+    created, missing = [], {}
+    for coll_name, models in MONGO_INDEXES.items():
+        coll = db[coll_name]
+        info = await coll.index_information()
+        for model in models:
+            doc = model.document
+            problem = _index_conflict(doc, info)
+            if problem is None:
+                continue
+            if problem != "no existe":
+                # create_index fallaría (IndexOptionsConflict); cambiarlo exige borrar el índice a mano
+                missing[f"{coll_name}.{doc['name']}"] = problem
+                logger.warning("Índice %s.%s no creado: %s", coll_name, doc["name"], problem)
+                continue
+            try:
+                await coll.create_indexes([model])
+                created.append(f"{coll_name}.{doc['name']}")
+            except Exception as e:
+                missing[f"{coll_name}.{doc['name']}"] = str(e)
+                logger.warning("Índice %s.%s no creado (las consultas sobre %s harán collection scan): %s",
+                               coll_name, doc["name"], coll_name, e)
+    if created:
+        logger.info("Índices de MongoDB creados: %s", ", ".join(created))
+    _index_state.update(checked_at=datetime.utcnow(), created=created, missing=missing)
+    return _index_state
+
+
+async def index_report() -> dict:
+    """Índices declarados vs existentes y uso de cada uno ($indexStats: operaciones desde el arranque de mongod)."""
+    report = {}
+    for coll_name, models in MONGO_INDEXES.items():
+        coll = db[coll_name]
+        info = await coll.index_information()
+        try:
+            usage = {s["name"]: {"ops": s["accesses"]["ops"], "since": s["accesses"]["since"]}
+                     async for s in coll.aggregate([{"$indexStats": {}}])}
+        except Exception as e:
+            usage = {"error": str(e)}
+        problems = {m.document["name"]: _index_conflict(m.document, info) for m in models}
+        report[coll_name] = {
+            "missing": sorted(name for name, problem in problems.items() if problem is not None),
+            "conflicts": {name: problem for name, problem in sorted(problems.items())
+                          if problem not in (None, "no existe")},
+            "indexes": sorted(info),
+            "usage": usage,
+            "unused": sorted(n for n, u in usage.items() if isinstance(u, dict) and u["ops"] == 0 and n != "_id_"),
+        }
+    return report
+
+
+_SEED_META_ID = "seed_products"
+
+
+def _product_content_hash(p: dict) -> str:
+    """Hash del contenido del producto (sin created_at, que cambia en cada arranque)."""
+    payload = {k: v for k, v in p.items() if k != "created_at"}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
 async def seed_products():
-    """Sincroniza los productos del backend con la BD (inserta o actualiza por id)."""
-    if db is None:
+    """Sincroniza los productos del backend con la BD (inserta o actualiza por id).
+    Si el hash del catálogo coincide con el guardado no se escribe nada; si no, un único bulk_write
+    con solo los productos que han cambiado."""
+    if not db_available():
         logger.info("MongoDB no disponible. Productos servidos desde memoria.")
         return
     try:
+        hashes = {p["id"]: _product_content_hash(p) for p in SEED_PRODUCTS}
+        catalog_hash = hashlib.sha256("".join(f"{k}:{v};" for k, v in sorted(hashes.items())).encode()).hexdigest()
+        meta = await db.app_meta.find_one({"_id": _SEED_META_ID})
+        if meta and meta.get("hash") == catalog_hash:
+            logger.info("Catálogo sin cambios (%d productos): no se escribe en MongoDB", len(SEED_PRODUCTS))
+            return
+
+        stored = {}
+        async for d in db.products.find({}, {"_id": 0, "id": 1, "content_hash": 1}):
+            stored[d.get("id")] = d.get("content_hash")
+        ops = []
         for p in SEED_PRODUCTS:
-            doc = dict(p)
-            await db.products.replace_one(
-                {"id": doc["id"]},
-                doc,
-                upsert=True
-            )
-        logger.info(f"Seeded/synced {len(SEED_PRODUCTS)} products")
+            if stored.get(p["id"]) == hashes[p["id"]]:
+                continue
+            fields = {k: v for k, v in p.items() if k != "created_at"}
+            ops.append(UpdateOne(
+                {"id": p["id"]},
+                {"$set": {**fields, "content_hash": hashes[p["id"]]}, "$setOnInsert": {"created_at": p["created_at"]}},
+                upsert=True,
+            ))
+        if ops:
+            await db.products.bulk_write(ops, ordered=False)
+        await db.app_meta.replace_one(
+            {"_id": _SEED_META_ID},
+            {"_id": _SEED_META_ID, "hash": catalog_hash, "products": len(SEED_PRODUCTS), "updated_at": datetime.utcnow()},
+            upsert=True,
+        )
+        invalidate_catalog_cache()
+        logger.info(f"Seeded/synced {len(ops)} of {len(SEED_PRODUCTS)} products")
     except Exception as e:
         logger.warning(f"No se pudo hacer seed en MongoDB: {e}. Productos desde memoria.")
 
@@ -926,69 +2451,230 @@ async def root():
 @api_router.get("/health")
 async def health():
     """Comprueba que es este backend y que la API está lista (incl. offer-request)."""
-    return {"status": "ok", "message": "AQUALAN API", "offer_request": "POST /api/offer-request"}
+    return {
+        "status": "ok",
+        "message": "AQUALAN API",
+        "offer_request": "POST /api/offer-request",
+        "delivery_cache": delivery_cache_stats(),
+        "routes": {**_routes_state, "localities": len(_ROUTE_INDEX["exact"])},
+        "startup": _startup_summary(),
+        "catalog": _catalog_summary(),
+        "email_providers": {b.name: b.summary() for b in _email_providers()},
+        "mongo": {"configured": db is not None, **_db_health},
+        "memory_orders": _orders_in_memory.stats(),
+        "write_limits": {"inflight": dict(_write_inflight), "clients": len(_rate_buckets), **_rate_limit_stats},
+        "order_journal": _order_journal.summary(),
+        "mongo_indexes": {"checked_at": _index_state["checked_at"], "missing": sorted(_index_state["missing"])},
+        "order_emails": {"mode": ORDER_EMAIL_MODE, "digest_times": ORDER_DIGEST_TIMES, **_digest_stats},
+    }
 
 
-def _products_fallback(category: Optional[str] = None, brand: Optional[str] = None):
-    """Devuelve productos desde SEED_PRODUCTS filtrados por categoría/marca."""
-    filtered = [
-        p for p in SEED_PRODUCTS
-        if (not category or p.get("category") == category)
-        and (not brand or p.get("brand") == brand)
-    ]
-    return [Product(**{**p, "created_at": p.get("created_at", datetime.utcnow())}) for p in filtered]
+def _catalog_summary() -> dict:
+    cache = _catalog_cache
+    if cache is None:
+        return {"cached": False}
+    return {"cached": True, "source": cache["source"], "products": len(cache["products"]), "loaded_at": cache["loaded_at"]}
+
+
+def _startup_summary() -> dict:
+    return {
+        "mode": "fast" if FAST_STARTUP else "full",
+        "ready": _startup_state["ready"],
+        "pending": sorted(_startup_state["pending"]),
+        "timings_ms": dict(_startup_state["timings_ms"]),
+        "ready_after_ms": _startup_state["ready_after_ms"],
+    }
+
+
+@api_router.get("/health/live")
+async def health_live():
+    """Liveness: el proceso responde."""
+    return {"status": "ok"}
+
+
+@api_router.get("/health/ready")
+async def health_ready():
+    """Readiness: 503 mientras quedan pasos de arranque pendientes (solo ocurre con FAST_STARTUP)."""
+    summary = _startup_summary()
+    if not summary["ready"]:
+        return JSONResponse(status_code=503, content={"status": "starting", **summary})
+    return {"status": "ready", **summary}
+
+
+# Caché del catálogo en memoria: productos ya validados, con la URL de imagen resuelta y vistas
+# precalculadas por categoría/marca. Se renueva pasado CATALOG_CACHE_TTL o al invalidarla (seed / admin).
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "300"))
+# Si MongoDB falla se sirve el catálogo en memoria, pero se reintenta antes
+_CATALOG_FALLBACK_TTL = min(CATALOG_CACHE_TTL, 30.0)
+_catalog_cache: Optional[dict] = None
+_seed_catalog: Optional[dict] = None
+_catalog_lock = asyncio.Lock()
+
+
+def _build_catalog(docs: List[dict], source: str, ttl: float) -> dict:
+    products = []
+    for doc in docs:
+        p = {**doc, "created_at": doc.get("created_at") or datetime.utcnow()}
+        if p.get("id"):
+            # Forzar siempre la URL de imagen a nuestro backend actual
+            p["image_url"], p["image_variants"] = _product_image_urls(p["id"])
+        products.append(Product(**p))
+    views: dict = {}
+    for p in products:
+        keys = {(None, None), (p.category, None)}
+        if p.brand:
+            keys |= {(None, p.brand), (p.category, p.brand)}
+        for key in keys:
+            views.setdefault(key, []).append(p)
+    return {
+        "source": source,
+        "products": products,
+        "by_id": {p.id: p for p in products},
+        "views": views,
+        "expires_at": time.monotonic() + ttl,
+        "loaded_at": datetime.utcnow(),
+    }
+
+
+def _get_seed_catalog() -> dict:
+    global _seed_catalog
+    if _seed_catalog is None:
+        _seed_catalog = _build_catalog(SEED_PRODUCTS, "memoria", float("inf"))
+    return _seed_catalog
+
+
+def invalidate_catalog_cache() -> None:
+    global _catalog_cache, _seed_catalog
+    _catalog_cache = None
+    _seed_catalog = None
+
+
+async def _get_catalog() -> dict:
+    """Catálogo vigente: desde MongoDB si está disponible, si no desde SEED_PRODUCTS."""
+    global _catalog_cache
+    cache = _catalog_cache
+    if cache is not None and time.monotonic() < cache["expires_at"]:
+        return cache
+    async with _catalog_lock:
+        cache = _catalog_cache
+        if cache is not None and time.monotonic() < cache["expires_at"]:
+            return cache
+        docs = None
+        if db_available():
+            try:
+                docs = await db.products.find({}).to_list(1000)
+            except Exception as e:
+                _db_failed(e)
+                logger.warning(f"Error leyendo productos de MongoDB: {e}. Usando lista en memoria.")
+        if docs:
+            cache = _build_catalog(docs, "mongo", CATALOG_CACHE_TTL)
+        else:
+            _FALLBACKS.inc("products")
+            seed = _get_seed_catalog()
+            ttl = CATALOG_CACHE_TTL if db is None else _CATALOG_FALLBACK_TTL
+            cache = {**seed, "expires_at": time.monotonic() + ttl}
+        _catalog_cache = cache
+        return cache
+
+
+def _catalog_view(catalog: dict, category: Optional[str], brand: Optional[str]) -> List[Product]:
+    return catalog["views"].get((category or None, brand or None), [])
+
+
+# Respuestas de lectura pre-serializadas: bytes JSON (y gzip) con ETag fuerte, calculados una vez por
+# vista del catálogo. Con If-None-Match coincidente se responde 304 sin cuerpo.
+CATALOG_MAX_AGE = int(os.environ.get("CATALOG_MAX_AGE", "300"))
+_PRODUCT_LIST_ADAPTER = TypeAdapter(List[Product])
+
+
+def _encode_payload(body: bytes) -> dict:
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    return {
+        "body": body,
+        "gzip": gzip.compress(body, compresslevel=6) if len(body) >= 512 else None,
+        "etag": f'"{digest}"',
+        "etag_gzip": f'"{digest}-gz"',
+    }
+
+
+_EMPTY_LIST_PAYLOAD = _encode_payload(b"[]")
+
+
+def _catalog_payload(catalog: dict, key, build) -> dict:
+    encoded = catalog.setdefault("encoded", {})
+    payload = encoded.get(key)
+    if payload is None:
+        payload = encoded[key] = _encode_payload(build())
+    return payload
+
+
+def _etag_matches(request: Request, payload: dict) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = {t.strip().removeprefix("W/") for t in header.split(",")}
+    return payload["etag"] in tags or payload["etag_gzip"] in tags
+
+
+def _cached_json_response(request: Request, payload: dict, max_age: int = CATALOG_MAX_AGE) -> Response:
+    use_gzip = payload["gzip"] is not None and "gzip" in request.headers.get("accept-encoding", "")
+    headers = {
+        "ETag": payload["etag_gzip"] if use_gzip else payload["etag"],
+        "Cache-Control": f"public, max-age={max_age}",
+        "Vary": "Accept-Encoding",
+    }
+    if _etag_matches(request, payload):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(payload["gzip"], media_type="application/json", headers=headers)
+    return Response(payload["body"], media_type="application/json", headers=headers)
 
 
 # Products endpoints
 @api_router.get("/products", response_model=List[Product])
-async def get_products(category: Optional[str] = None, brand: Optional[str] = None):
-    if db is not None:
-        try:
-            query = {}
-            if category:
-                query["category"] = category
-            if brand:
-                query["brand"] = brand
-            products = await db.products.find(query).to_list(100)
-            if products:
-                # Forzar siempre la URL de imagen a nuestro backend actual
-                for p in products:
-                    pid = p.get("id")
-                    if pid:
-                        p["image_url"] = f"{_STATIC_BASE}/static/products/{pid}.jpg"
-                return [Product(**p) for p in products]
-        except Exception as e:
-            logger.warning(f"Error leyendo productos de MongoDB: {e}. Usando lista en memoria.")
-    return _products_fallback(category, brand)
+async def get_products(request: Request, category: Optional[str] = None, brand: Optional[str] = None):
+    catalog = await _get_catalog()
+    if not _catalog_view(catalog, category, brand):
+        catalog = _get_seed_catalog()
+    view_key = (category or None, brand or None)
+    if view_key not in catalog["views"]:
+        # Filtro desconocido: respuesta vacía compartida, sin añadir una entrada por cada cadena recibida
+        return _cached_json_response(request, _EMPTY_LIST_PAYLOAD)
+    payload = _catalog_payload(catalog, ("list", *view_key),
+                               lambda: _PRODUCT_LIST_ADAPTER.dump_json(catalog["views"][view_key]))
+    return _cached_json_response(request, payload)
 
 
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    if db is not None:
-        try:
-            product = await db.products.find_one({"id": product_id})
-            if product:
-                product["image_url"] = f"{_STATIC_BASE}/static/products/{product_id}.jpg"
-                return Product(**product)
-        except Exception:
-            pass
-    for p in SEED_PRODUCTS:
-        if p.get("id") == product_id:
-            return Product(**{**p, "created_at": p.get("created_at", datetime.utcnow())})
-    raise HTTPException(status_code=404, detail="Producto no encontrado")
+async def get_product(request: Request, product_id: str):
+    catalog = await _get_catalog()
+    product = catalog["by_id"].get(product_id)
+    if product is None:
+        catalog = _get_seed_catalog()
+        product = catalog["by_id"].get(product_id)
+    if product is None:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    payload = _catalog_payload(catalog, ("product", product_id), product.model_dump_json().encode)
+    return _cached_json_response(request, payload)
+
+
+CATEGORIES = [
+    {"id": "botellones", "name": "Botellones", "description": "Botellones de 12L y 19L", "icon": "water"},
+    {"id": "ecobox", "name": "Ecobox", "description": "Formato bag in box ecológico", "icon": "leaf"},
+    {"id": "botellines", "name": "Botellines", "description": "Botellas de 0.33L a 1.5L", "icon": "flask"},
+    {"id": "dispensadores", "name": "Dispensadores", "description": "Dispensadores de agua fría/caliente", "icon": "beaker"},
+    {"id": "vasos", "name": "Vasos", "description": "Vasos plásticos y compostables", "icon": "cup"},
+    {"id": "cafe", "name": "Café", "description": "Cafeteras y cápsulas", "icon": "cafe"}
+]
+_CATEGORIES_PAYLOAD = _encode_payload(json.dumps(CATEGORIES, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
 
 
 @api_router.get("/categories")
-async def get_categories():
-    categories = [
-        {"id": "botellones", "name": "Botellones", "description": "Botellones de 12L y 19L", "icon": "water"},
-        {"id": "ecobox", "name": "Ecobox", "description": "Formato bag in box ecológico", "icon": "leaf"},
-        {"id": "botellines", "name": "Botellines", "description": "Botellas de 0.33L a 1.5L", "icon": "flask"},
-        {"id": "dispensadores", "name": "Dispensadores", "description": "Dispensadores de agua fría/caliente", "icon": "beaker"},
-        {"id": "vasos", "name": "Vasos", "description": "Vasos plásticos y compostables", "icon": "cup"},
-        {"id": "cafe", "name": "Café", "description": "Cafeteras y cápsulas", "icon": "cafe"}
-    ]
-    return categories
+async def get_categories(request: Request):
+    return _cached_json_response(request, _CATEGORIES_PAYLOAD)
 
 
 # Delivery date endpoint
@@ -998,32 +2684,545 @@ async def get_delivery_date(city: str):
     return get_next_delivery_date(city)
 
 
+@api_router.get("/delivery-calendar")
+async def delivery_calendar(n: int = 4, city: Optional[str] = None):
+    """Próximas n fechas de reparto por localidad (todas, o solo la ruta que corresponde a city)."""
+    if n < 1 or n > CALENDAR_MAX_DATES:
+        raise HTTPException(status_code=400, detail=f"n debe estar entre 1 y {CALENDAR_MAX_DATES}")
+    calendar = get_delivery_calendar(n)
+    if city is not None:
+        entry = _resolve_route(city)
+        key = entry["key"] if entry is not None else None
+        calendar["routes"] = [r for r in calendar["routes"] if r["city"] == key]
+    return calendar
+
+
+def _require_admin(x_admin_key: Optional[str]) -> None:
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=503, detail="Administración desactivada: configura ADMIN_API_KEY")
+    if x_admin_key != ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail="Clave de administración incorrecta")
+
+
+@api_router.post("/admin/reload-routes")
+async def admin_reload_routes(x_admin_key: Optional[str] = Header(None)):
+    """Recarga rutas.xlsx sin reiniciar el servidor."""
+    _require_admin(x_admin_key)
+    try:
+        state = await asyncio.to_thread(reload_routes)
+    except ValueError as e:
+        _routes_state["last_error"] = str(e)
+        raise HTTPException(status_code=422, detail=f"rutas.xlsx no válido, se mantienen las rutas actuales: {e}")
+    return {"message": "Rutas recargadas", **state, "routes": len(_ROUTE_INDEX["exact"])}
+
+
+@api_router.post("/admin/catalog/invalidate")
+async def admin_invalidate_catalog(x_admin_key: Optional[str] = Header(None)):
+    """Descarta la caché del catálogo tras editar productos directamente en MongoDB."""
+    _require_admin(x_admin_key)
+    invalidate_catalog_cache()
+    return {"message": "Caché de catálogo invalidada"}
+
+
+@api_router.get("/admin/outbox")
+async def admin_outbox(x_admin_key: Optional[str] = Header(None)):
+    """Estado del outbox de emails: mensajes por estado en cada almacén y contadores del worker."""
+    _require_admin(x_admin_key)
+    stores = {}
+    for store in _outbox_stores():
+        try:
+            stores[store.name] = await store.counts()
+        except Exception as e:
+            stores[store.name] = {"error": str(e)}
+    return {"stores": stores, "worker": {"running": _outbox_task is not None and not _outbox_task.done(),
+                                         "unsaved": len(_outbox_unsaved), **_outbox_stats}}
+
+
+@api_router.get("/admin/indexes")
+async def admin_indexes(x_admin_key: Optional[str] = Header(None)):
+    """Índices de MongoDB: los que faltan de los declarados y el uso de cada uno."""
+    _require_admin(x_admin_key)
+    if not db_available():
+        raise HTTPException(status_code=503, detail="MongoDB no disponible")
+    return {"collections": await index_report(), "last_check": _index_state}
+
+
+@api_router.post("/admin/digest/send")
+async def admin_send_digest(x_admin_key: Optional[str] = Header(None)):
+    """Genera y encola ahora los resúmenes de reparto pendientes, sin esperar a la hora programada."""
+    _require_admin(x_admin_key)
+    return await send_route_digests()
+
+
+@api_router.post("/delivery-date/batch")
+async def get_delivery_date_batch(data: DeliveryDateBatchRequest):
+    """Calcula las fechas de entrega de una lista de ciudades en una sola llamada."""
+    results = get_delivery_dates(data.cities, data.reference_date)
+    return {
+        "reference_date": (data.reference_date or datetime.now()).strftime('%Y-%m-%d'),
+        "count": len(results),
+        "unique": len({_normalize_city(c) for c in data.cities}),
+        "results": results,
+    }
+
+
+# Límites para los endpoints de escritura. Token bucket por IP y por email ("N/S": N peticiones cada S
+# segundos, con ráfagas de hasta N; "0" desactiva) y un máximo de peticiones en curso por endpoint: al
+# superarlo se responde 429/503 con Retry-After en el acto en vez de encolar.
+# TRUSTED_PROXY_HOPS: número de proxies propios delante de uvicorn (Nginx, Render/Railway...). Con 0 (por
+# defecto) se usa la IP de la conexión y se ignora X-Forwarded-For, que cualquier cliente puede inventar si
+# uvicorn está expuesto directamente (--host 0.0.0.0). Con N se toma la IP que añadió el N-ésimo proxy
+# empezando por el final de X-Forwarded-For; ponlo solo si todo el tráfico pasa por esos proxies.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", "10000"))
+
+
+def _parse_rate(spec: str) -> Optional[tuple]:
+    try:
+        count, seconds = spec.split("/")
+        count, seconds = float(count), float(seconds)
+    except ValueError:
+        logger.warning("Límite de peticiones no válido %r (formato N/S); desactivado", spec)
+        return None
+    return (count, count / seconds) if count > 0 and seconds > 0 else None
+
+
+RATE_LIMITS = {
+    "orders": _parse_rate(os.environ.get("RATE_LIMIT_ORDERS", "10/60")),
+    "offer_request": _parse_rate(os.environ.get("RATE_LIMIT_OFFER_REQUEST", "5/60")),
+}
+WRITE_MAX_INFLIGHT = {
+    "orders": int(os.environ.get("ORDERS_MAX_INFLIGHT", "32")),
+    "offer_request": int(os.environ.get("OFFER_REQUEST_MAX_INFLIGHT", "8")),
+}
+_rate_buckets: "OrderedDict[tuple, list]" = OrderedDict()  # (ruta, cliente) -> [tokens, último relleno]
+_write_inflight = {route: 0 for route in WRITE_MAX_INFLIGHT}
+_rate_limit_stats = {"limited": 0, "shed": 0}
+
+
+def _client_ip(request: Request) -> str:
+    forwarded = [p.strip() for p in request.headers.get("x-forwarded-for", "").split(",") if p.strip()]
+    if TRUSTED_PROXY_HOPS > 0 and forwarded:
+        return forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+    return request.client.host if request.client else "desconocida"
+
+
+def _take_token(key: tuple, capacity: float, rate: float, now: float) -> float:
+    """Gasta un token del cubo; devuelve 0 si había, o los segundos hasta el siguiente."""
+    bucket = _rate_buckets.get(key)
+    if bucket is None:
+        bucket = _rate_buckets[key] = [capacity, now]
+        if len(_rate_buckets) > RATE_LIMIT_MAX_CLIENTS:
+            _rate_buckets.popitem(last=False)
+    else:
+        _rate_buckets.move_to_end(key)
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0.0
+    return (1 - bucket[0]) / rate
+
+
+def enforce_rate_limit(route: str, request: Request, email: Optional[str] = None) -> None:
+    limit = RATE_LIMITS.get(route)
+    if limit is None:
+        return
+    capacity, rate = limit
+    now = time.monotonic()
+    clients = [f"ip:{_client_ip(request)}"] + ([f"email:{email.strip().lower()}"] if email and email.strip() else [])
+    for client_key in clients:
+        wait = _take_token((route, client_key), capacity, rate, now)
+        if wait:
+            _rate_limit_stats["limited"] += 1
+            logger.warning("Límite de %s superado por %s", route, client_key)
+            raise HTTPException(status_code=429, detail="Demasiadas solicitudes. Inténtalo en unos segundos.",
+                                headers={"Retry-After": str(math.ceil(wait))})
+
+
+@contextlib.asynccontextmanager
+async def _write_slot(route: str):
+    cap = WRITE_MAX_INFLIGHT[route]
+    if cap > 0 and _write_inflight[route] >= cap:
+        _rate_limit_stats["shed"] += 1
+        raise HTTPException(status_code=503, detail="Servidor ocupado. Inténtalo en unos segundos.",
+                            headers={"Retry-After": "1"})
+    _write_inflight[route] += 1
+    try:
+        yield
+    finally:
+        _write_inflight[route] -= 1
+
+
 @api_router.post("/offer-request")
-async def submit_offer_request(data: OfferRequestForm):
+async def submit_offer_request(data: OfferRequestForm, request: Request):
     """Recibe el formulario de solicitud de oferta y envía email a info@aqualan.es."""
     has_email = True  # WP Mail endpoint siempre disponible
     if not has_email:
         logger.warning("offer-request: Ni RESEND_API_KEY ni SMTP configurados. Configura uno en el panel (Render/Railway).")
         raise HTTPException(status_code=503, detail="Servicio de email no configurado. Contacta con el administrador.")
+    enforce_rate_limit("offer_request", request, data.email)
     try:
-        ok = await asyncio.to_thread(_send_offer_request_email, data)
+        async with _write_slot("offer_request"):
+            ok = await _send_offer_request_email(data)
         if not ok:
             raise HTTPException(status_code=500, detail="No se pudo enviar la solicitud. Inténtalo más tarde.")
         return {"success": True, "message": "Solicitud enviada correctamente"}
     except HTTPException:
         raise
+    except EmailBackpressure as e:
+        logger.warning("offer-request: %s", e)
+        raise HTTPException(status_code=503, detail="Servicio de email saturado. Inténtalo en unos segundos.",
+                            headers={"Retry-After": str(int(EMAIL_QUEUE_TIMEOUT) or 1)})
     except Exception as e:
         logger.exception("offer-request: error enviando email: %s", e)
         raise HTTPException(status_code=500, detail="Error al enviar la solicitud. Inténtalo más tarde.")
 
 
-# Pedidos en memoria cuando MongoDB no está disponible
-_orders_in_memory: List[dict] = []
+# Pedidos en memoria cuando MongoDB no está disponible. Como mucho MEMORY_ORDERS_MAX pedidos: al superarlo
+# se descartan primero los entregados/cancelados más antiguos (y, si no hay, los más antiguos con un aviso).
+MEMORY_ORDERS_MAX = int(os.environ.get("MEMORY_ORDERS_MAX", "10000"))
+_FINISHED_STATUSES = ("entregado", "cancelado")
+
+
+class _MemoryOrderStore:
+    """Pedidos por id, con listas de claves (created_at, id) ordenadas: global, por email y de terminados."""
+
+    def __init__(self, max_orders: int):
+        self.max_orders = max_orders
+        self._by_id: Dict[str, dict] = {}
+        self._keys: List[tuple] = []
+        self._by_email: Dict[str, List[tuple]] = {}
+        self._finished: List[tuple] = []
+        self.evicted = 0
+
+    @staticmethod
+    def _key(doc: dict) -> tuple:
+        return doc["created_at"], doc["id"]
+
+    @staticmethod
+    def _discard(keys: List[tuple], key: tuple) -> None:
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def add(self, doc: dict) -> None:
+        if doc["id"] in self._by_id:
+            self._remove(doc["id"])
+        key = self._key(doc)
+        self._by_id[doc["id"]] = doc
+        bisect.insort(self._keys, key)
+        bisect.insort(self._by_email.setdefault(doc.get("customer_email") or "", []), key)
+        if doc.get("status") in _FINISHED_STATUSES:
+            bisect.insort(self._finished, key)
+        while len(self._by_id) > self.max_orders:
+            self._evict()
+
+    def _remove(self, order_id: str) -> dict:
+        doc = self._by_id.pop(order_id)
+        key = self._key(doc)
+        self._discard(self._keys, key)
+        email = doc.get("customer_email") or ""
+        self._discard(self._by_email[email], key)
+        if not self._by_email[email]:
+            del self._by_email[email]
+        self._discard(self._finished, key)
+        return doc
+
+    def _evict(self) -> None:
+        if self._finished:
+            self._remove(self._finished[0][1])
+        else:
+            doc = self._remove(self._keys[0][1])
+            logger.warning("Pedidos en memoria al límite (%d): descartado el pedido %s (%s) sin entregar",
+                           self.max_orders, doc["id"], doc.get("status"))
+        self.evicted += 1
+
+    def get(self, order_id: str) -> Optional[dict]:
+        return self._by_id.get(order_id)
+
+    def set_status(self, order_id: str, status: str, now: datetime) -> bool:
+        doc = self._by_id.get(order_id)
+        if doc is None:
+            return False
+        key = self._key(doc)
+        was_finished = doc.get("status") in _FINISHED_STATUSES
+        doc["status"], doc["updated_at"] = status, now
+        if status in _FINISHED_STATUSES and not was_finished:
+            bisect.insort(self._finished, key)
+        elif was_finished and status not in _FINISHED_STATUSES:
+            self._discard(self._finished, key)
+        return True
+
+    def page(self, email: Optional[str], after: Optional[tuple], limit: int) -> List[dict]:
+        """Hasta limit pedidos anteriores a la clave after, del más reciente al más antiguo."""
+        keys = self._keys if not email else self._by_email.get(email, [])
+        end = len(keys) if after is None else bisect.bisect_left(keys, after)
+        return [self._by_id[k[1]] for k in reversed(keys[max(0, end - limit):end])]
+
+    def since(self, created_from: Optional[datetime] = None) -> List[dict]:
+        """Pedidos creados desde created_from (todos si es None), del más antiguo al más reciente."""
+        start = 0 if created_from is None else bisect.bisect_left(self._keys, (created_from, ""))
+        return [self._by_id[k[1]] for k in self._keys[start:]]
+
+    def stats(self) -> dict:
+        return {"orders": len(self._by_id), "max": self.max_orders, "finished": len(self._finished),
+                "customers": len(self._by_email), "evicted": self.evicted}
+
+
+_orders_in_memory = _MemoryOrderStore(MEMORY_ORDERS_MAX)
+
+
+# Diario en disco de los pedidos que no llegaron a MongoDB (una línea JSON por versión del pedido, la última
+# gana). Las escrituras se agrupan: las que llegan en ORDER_JOURNAL_COMMIT_MS comparten un único fsync.
+# Al arrancar se reproduce en memoria y una tarea de fondo los sube a db.orders (upsert por id) cuando
+# MongoDB responde; lo ya sincronizado se compacta fuera del fichero.
+ORDER_JOURNAL_PATH = Path(os.environ.get("ORDER_JOURNAL_PATH", str(ROOT_DIR / ".cache" / "orders.journal")))
+ORDER_JOURNAL_COMMIT_MS = float(os.environ.get("ORDER_JOURNAL_COMMIT_MS", "2"))
+ORDER_JOURNAL_SYNC_INTERVAL = float(os.environ.get("ORDER_JOURNAL_SYNC_INTERVAL", "30"))
+_JOURNAL_DATETIME_FIELDS = ("created_at", "updated_at", "digest_sent_at")
+
+
+class _OrderJournal:
+    def __init__(self, path: Path):
+        self.path = path
+        self.unsynced: Dict[str, dict] = {}
+        self._pending: List[tuple] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._io_lock = asyncio.Lock()
+        self.stats = {"appended": 0, "fsyncs": 0, "synced": 0, "last_sync": None, "last_error": None}
+
+    async def append(self, doc: dict) -> None:
+        """Añade el pedido al diario y espera a que esté en disco (fsync compartido con el resto del lote)."""
+        self.unsynced[doc["id"]] = doc
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((json.dumps(doc, ensure_ascii=False, default=_json_default), future))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+        await future
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(ORDER_JOURNAL_COMMIT_MS / 1000)
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                async with self._io_lock:
+                    await asyncio.to_thread(self._write, [line for line, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+
+    def _write(self, lines: List[str]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats["appended"] += len(lines)
+        self.stats["fsyncs"] += 1
+
+    def _read(self) -> List[dict]:
+        """Lee el diario (en un hilo, sin tocar el estado compartido). Ignora una última línea a medio escribir."""
+        docs = []
+        if not self.path.exists():
+            return docs
+        with open(self.path, encoding="utf-8") as f:
+            for n, line in enumerate(f, 1):
+                try:
+                    doc = json.loads(line)
+                except ValueError:
+                    logger.warning("Diario de pedidos: línea %d ilegible, se ignora", n)
+                    continue
+                for k in _JOURNAL_DATETIME_FIELDS:
+                    if doc.get(k):
+                        doc[k] = datetime.fromisoformat(doc[k])
+                docs.append(doc)
+        return docs
+
+    async def replay(self) -> int:
+        """Carga el diario en unsynced y en los pedidos en memoria. El fichero se lee en un hilo, pero el estado
+        se modifica en el event loop; lo escrito desde el arranque (más reciente) no se sobrescribe."""
+        async with self._io_lock:
+            docs = await asyncio.to_thread(self._read)
+        latest = {doc["id"]: doc for doc in docs}  # la última línea de cada pedido es su estado vigente
+        for order_id, doc in latest.items():
+            if order_id not in self.unsynced:
+                self.unsynced[order_id] = doc
+                _orders_in_memory.add(doc)
+        return len(latest)
+
+    def _rewrite(self, docs: List[dict]) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(d, ensure_ascii=False, default=_json_default) + "\n" for d in docs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    async def sync(self) -> int:
+        """Sube a MongoDB los pedidos pendientes (upsert por id: repetir no duplica) y compacta el diario."""
+        if not db_available() or not self.unsynced:
+            return 0
+        docs = {order_id: dict(doc) for order_id, doc in self.unsynced.items()}
+        try:
+            await db.orders.bulk_write(
+                [UpdateOne({"id": order_id}, {"$set": doc}, upsert=True) for order_id, doc in docs.items()],
+                ordered=False,
+            )
+        except Exception as e:
+            _db_failed(e)
+            self.stats["last_error"] = str(e)
+            raise
+        for order_id, doc in docs.items():
+            if self.unsynced.get(order_id) == doc:  # no ha cambiado mientras se subía
+                del self.unsynced[order_id]
+        async with self._io_lock:
+            await asyncio.to_thread(self._rewrite, list(self.unsynced.values()))
+        self.stats.update(synced=self.stats["synced"] + len(docs), last_sync=datetime.utcnow(), last_error=None)
+        logger.info("Diario de pedidos: %d pedido(s) sincronizados con MongoDB", len(docs))
+        return len(docs)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+
+    def summary(self) -> dict:
+        return {"unsynced": len(self.unsynced), **self.stats}
+
+
+_order_journal = _OrderJournal(ORDER_JOURNAL_PATH)
+
+
+async def _remember_order(doc: dict) -> None:
+    """Guarda en memoria y en el diario un pedido (o un cambio de estado) que no pudo ir a MongoDB."""
+    _FALLBACKS.inc("orders_write")
+    _orders_in_memory.add(doc)
+    try:
+        await _order_journal.append(doc)
+    except Exception as e:
+        logger.error("No se pudo escribir el pedido %s en el diario (se perderá al reiniciar): %s", doc["id"], e)
+
+
+async def _replay_order_journal() -> None:
+    """Paso de arranque. La sincronización empieza después: compactar el diario antes de haberlo leído
+    entero perdería los pedidos aún no cargados."""
+    replayed = await _order_journal.replay()
+    if replayed:
+        logger.info("Diario de pedidos: %d pedido(s) pendientes de subir a MongoDB", replayed)
+    _background_tasks.append(asyncio.create_task(_order_journal_sync_worker()))
+
+
+async def _order_journal_sync_worker() -> None:
+    """Tarea de fondo: cada ORDER_JOURNAL_SYNC_INTERVAL segundos intenta subir los pedidos del diario."""
+    while True:
+        if _order_journal.unsynced and db_available():
+            try:
+                await _order_journal.sync()
+            except Exception as e:
+                logger.warning("Diario de pedidos: %d pedido(s) sin sincronizar, MongoDB no disponible (%s)",
+                               len(_order_journal.unsynced), e)
+        await asyncio.sleep(ORDER_JOURNAL_SYNC_INTERVAL)
+
+
+# Idempotency-Key en POST /api/orders: un reintento del móvil con la misma clave devuelve el pedido original
+# (sin insertarlo ni encolar emails otra vez) y los duplicados simultáneos esperan a la única creación en curso.
+# Las claves se guardan en MongoDB (db.idempotency_keys, índice TTL) o en memoria si no está disponible.
+IDEMPOTENCY_MEMORY_MAX = int(os.environ.get("IDEMPOTENCY_MEMORY_MAX", "10000"))
+_idempotency_memory: "OrderedDict[str, dict]" = OrderedDict()
+_idempotency_inflight: Dict[str, asyncio.Future] = {}
+
+
+def _order_fingerprint(order_data: OrderCreate) -> str:
+    return hashlib.sha256(order_data.model_dump_json().encode("utf-8")).hexdigest()
+
+
+async def _idempotency_lookup(key: str) -> Optional[dict]:
+    expired_before = datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL)
+    if db_available():
+        try:
+            # El monitor TTL de MongoDB borra cada ~60 s: se filtra también por fecha
+            record = await db.idempotency_keys.find_one({"_id": key, "created_at": {"$gt": expired_before}})
+            if record is not None:
+                return record
+        except Exception as e:
+            _db_failed(e)
+    record = _idempotency_memory.get(key)
+    if record is not None and record["created_at"] <= expired_before:
+        del _idempotency_memory[key]
+        return None
+    return record
+
+
+async def _idempotency_save(record: dict) -> None:
+    if db_available():
+        try:
+            await db.idempotency_keys.replace_one({"_id": record["_id"]}, record, upsert=True)
+            return
+        except Exception as e:
+            _db_failed(e)
+    _idempotency_memory[record["_id"]] = record
+    while len(_idempotency_memory) > IDEMPOTENCY_MEMORY_MAX:
+        _idempotency_memory.popitem(last=False)
+
+
+async def _create_order_once(key: str, order_data: OrderCreate, create) -> tuple:
+    """Devuelve (registro, repetido). Solo la primera petición con la clave llama a create() y crea el pedido;
+    las repeticiones no pasan por el límite de peticiones ni ocupan hueco de escritura."""
+    inflight = _idempotency_inflight.get(key)
+    if inflight is not None:
+        return await asyncio.shield(inflight), True
+    future = asyncio.get_running_loop().create_future()
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())  # sin avisos si nadie más esperaba
+    _idempotency_inflight[key] = future
+    try:
+        record = await _idempotency_lookup(key)
+        replayed = record is not None
+        if record is None:
+            order = await create()
+            record = {"_id": key, "fingerprint": _order_fingerprint(order_data), "order": order.dict(),
+                      "created_at": datetime.utcnow()}
+            await _idempotency_save(record)
+        future.set_result(record)
+        return record, replayed
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        del _idempotency_inflight[key]
 
 
 # Orders endpoints
 @api_router.post("/orders", response_model=Order)
-async def create_order(order_data: OrderCreate):
+async def create_order(order_data: OrderCreate, request: Request, response: Response,
+                       idempotency_key: Optional[str] = Header(None)):
+    async def create() -> Order:
+        enforce_rate_limit("orders", request, order_data.customer_email)
+        async with _write_slot("orders"):
+            return await _create_order(order_data)
+
+    if not idempotency_key:
+        return await create()
+    key = idempotency_key.strip()
+    if not key or len(key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key no válida (1-255 caracteres)")
+    record, replayed = await _create_order_once(key, order_data, create)
+    if record["fingerprint"] != _order_fingerprint(order_data):
+        raise HTTPException(status_code=409, detail="Idempotency-Key ya usada con un pedido distinto")
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return Order(**record["order"])
+
+
+async def _create_order(order_data: OrderCreate) -> Order:
     # Calcular fecha de entrega
     delivery_info = get_next_delivery_date(order_data.delivery_city or "")
     
@@ -1040,63 +3239,249 @@ async def create_order(order_data: OrderCreate):
         delivery_day=delivery_info.get('day_name')
     )
     
-    if db is not None:
+    if db_available():
         try:
             await db.orders.insert_one(order.dict())
         except Exception as e:
-            logger.warning(f"No se pudo guardar el pedido en BD: {e}. Guardando en memoria.")
-            _orders_in_memory.append(order.dict())
+            _db_failed(e)
+            logger.warning(f"No se pudo guardar el pedido en BD: {e}. Guardando en memoria y en el diario.")
+            await _remember_order(order.dict())
     else:
-        _orders_in_memory.append(order.dict())
+        await _remember_order(order.dict())
     
-    # Enviar emails (esperamos a que se envíen para que no se pierdan en Render)
-    has_email = True  # WP Mail endpoint siempre disponible
-    if not has_email:
-        logger.warning("create_order: Ni RESEND_API_KEY ni SMTP configurados. No se envían emails.")
-    else:
-        try:
-            await asyncio.to_thread(_send_order_email_sync, order, delivery_info, False)
-            logger.info("Email pedido enviado a %s", EMAIL_TO)
-        except Exception as e:
-            logger.exception("Error enviando email a empresa (pedido %s): %s", order.id, e)
-        try:
-            await asyncio.to_thread(_send_order_email_sync, order, delivery_info, True)
-            logger.info("Email pedido enviado al cliente %s", order.customer_email)
-        except Exception as e:
-            logger.exception("Error enviando email al cliente (pedido %s): %s", order.id, e)
+    # Los emails quedan en el outbox y los entrega el worker: no se hace esperar al cliente
+    try:
+        store = await enqueue_order_emails(order, delivery_info)
+        logger.info("Emails del pedido %s encolados (%s)", order.id, store)
+    except Exception as e:
+        logger.exception("No se pudieron encolar los emails del pedido %s: %s", order.id, e)
 
     return order
 
 
-@api_router.get("/orders", response_model=List[Order])
-async def get_orders(email: Optional[str] = None):
-    if db is not None:
+# Paginación por keyset de GET /api/orders: orden (created_at, id) descendente. El cursor es opaco (la clave
+# del último pedido devuelto) y llega en la cabecera X-Next-Cursor; sin cabecera no hay más páginas.
+ORDERS_PAGE_MAX = int(os.environ.get("ORDERS_PAGE_MAX", "500"))
+_ORDER_SUMMARY_PROJECTION = {"_id": 0, **{f: 1 for f in OrderSummary.model_fields}}
+
+
+def _encode_order_cursor(order: dict) -> str:
+    raw = json.dumps([order["created_at"].isoformat(), order["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_order_cursor(cursor: str) -> tuple:
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created_at), str(order_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+
+@api_router.get("/orders", response_model=Union[List[Order], List[OrderSummary]])
+async def get_orders(response: Response, email: Optional[str] = None, limit: int = 100,
+                     cursor: Optional[str] = None, view: str = "full"):
+    """Pedidos más recientes primero, de limit en limit. view=summary devuelve solo los campos de listado."""
+    if limit < 1 or limit > ORDERS_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit debe estar entre 1 y {ORDERS_PAGE_MAX}")
+    if view not in ("full", "summary"):
+        raise HTTPException(status_code=400, detail="view debe ser 'full' o 'summary'")
+    after = _decode_order_cursor(cursor) if cursor else None
+    orders = None
+    if db_available():
         try:
             query = {}
             if email:
                 query["customer_email"] = email
-            orders = await db.orders.find(query).sort("created_at", -1).to_list(100)
-            return [Order(**o) for o in orders]
-        except Exception:
-            pass
-    # Fallback: pedidos en memoria
-    filtered = _orders_in_memory if not email else [o for o in _orders_in_memory if o.get("customer_email") == email]
-    filtered = sorted(filtered, key=lambda o: o.get("created_at"), reverse=True)[:100]
-    return [Order(**o) for o in filtered]
+            if after is not None:
+                query["$or"] = [{"created_at": {"$lt": after[0]}}, {"created_at": after[0], "id": {"$lt": after[1]}}]
+            projection = _ORDER_SUMMARY_PROJECTION if view == "summary" else {"_id": 0}
+            orders = await db.orders.find(query, projection).sort(
+                [("created_at", DESCENDING), ("id", DESCENDING)]).limit(limit + 1).to_list(limit + 1)
+        except Exception as e:
+            _db_failed(e)
+            orders = None
+    if orders is None:
+        # Fallback: pedidos en memoria
+        _FALLBACKS.inc("orders_read")
+        orders = _orders_in_memory.page(email, after, limit + 1)
+    if len(orders) > limit:
+        orders = orders[:limit]
+        response.headers["X-Next-Cursor"] = _encode_order_cursor(orders[-1])
+    model = OrderSummary if view == "summary" else Order
+    return [model(**o) for o in orders]
+
+
+# Exportación de pedidos para facturación y planificación de rutas. Se recorre un cursor de MongoDB (o los
+# pedidos en memoria) y se va escribiendo la respuesta por trozos: la memoria no crece con el número de pedidos.
+# CSV y XLSX llevan una fila por línea de producto; NDJSON un pedido completo por línea.
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+_EXPORT_ORDER_COLUMNS = ["order_id", "created_at", "status", "delivery_date", "delivery_day", "delivery_city",
+                         "customer_name", "customer_email", "customer_phone", "delivery_address", "notes"]
+_EXPORT_ITEM_COLUMNS = ["product_id", "product_name", "quantity", "unit"]
+_EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _export_query(created_from: Optional[date], created_to: Optional[date], delivery_from: Optional[date],
+                  delivery_to: Optional[date], city: Optional[str], status: Optional[str]) -> dict:
+    query = {}
+    if created_from or created_to:
+        query["created_at"] = {}
+        if created_from:
+            query["created_at"]["$gte"] = datetime.combine(created_from, datetime.min.time())
+        if created_to:
+            query["created_at"]["$lt"] = datetime.combine(created_to + timedelta(days=1), datetime.min.time())
+    if delivery_from or delivery_to:
+        # delivery_date se guarda como "YYYY-MM-DD": el orden de texto es el de fechas
+        query["delivery_date"] = {}
+        if delivery_from:
+            query["delivery_date"]["$gte"] = delivery_from.isoformat()
+        if delivery_to:
+            query["delivery_date"]["$lte"] = delivery_to.isoformat()
+    if city and city.strip():
+        query["delivery_city"] = {"$regex": f"^\\s*{re.escape(city.strip())}\\s*$", "$options": "i"}
+    if status:
+        query["status"] = status
+    return query
+
+
+def _matches_export_query(order: dict, query: dict) -> bool:
+    """Mismo filtro que _export_query, para los pedidos en memoria."""
+    for field, cond in query.items():
+        value = order.get(field)
+        if isinstance(cond, dict) and "$regex" in cond:
+            if not re.match(cond["$regex"], value or "", re.IGNORECASE):
+                return False
+        elif isinstance(cond, dict):
+            if value is None:
+                return False
+            if "$gte" in cond and value < cond["$gte"]:
+                return False
+            if "$lt" in cond and value >= cond["$lt"]:
+                return False
+            if "$lte" in cond and value > cond["$lte"]:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+async def _iter_export_orders(query: dict):
+    yielded = False
+    if db_available():
+        try:
+            cursor = db.orders.find(query, {"_id": 0}).sort([("created_at", ASCENDING), ("id", ASCENDING)])
+            async for doc in cursor.batch_size(EXPORT_BATCH_SIZE):
+                yielded = True
+                yield doc
+            return
+        except Exception as e:
+            _db_failed(e)
+            if yielded:
+                raise
+            logger.warning("Exportación: MongoDB no disponible (%s). Exportando pedidos en memoria.", e)
+    for doc in _orders_in_memory.since(query.get("created_at", {}).get("$gte")):
+        if _matches_export_query(doc, query):
+            yield doc
+
+
+def _export_rows(order: dict):
+    head = [order.get("id"), order.get("created_at"), order.get("status"), order.get("delivery_date"),
+            order.get("delivery_day"), order.get("delivery_city"), order.get("customer_name"),
+            order.get("customer_email"), order.get("customer_phone"), order.get("delivery_address"), order.get("notes")]
+    items = order.get("items") or [{}]
+    for item in items:
+        yield head + [item.get(c) for c in _EXPORT_ITEM_COLUMNS]
+
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else str(value)
+
+
+async def _stream_ndjson(orders):
+    buf = []
+    async for order in orders:
+        buf.append(json.dumps(order, ensure_ascii=False, default=_json_default))
+        if len(buf) >= EXPORT_BATCH_SIZE:
+            yield ("\n".join(buf) + "\n").encode("utf-8")
+            buf = []
+    if buf:
+        yield ("\n".join(buf) + "\n").encode("utf-8")
+
+
+async def _stream_csv(orders):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    out.write("\ufeff")  # BOM para que Excel abra el CSV en UTF-8 (acentos)
+    writer.writerow(_EXPORT_ORDER_COLUMNS + _EXPORT_ITEM_COLUMNS)
+    n = 0
+    async for order in orders:
+        for row in _export_rows(order):
+            writer.writerow([v.isoformat(sep=" ", timespec="seconds") if isinstance(v, datetime) else v for v in row])
+        n += 1
+        if n % EXPORT_BATCH_SIZE == 0:
+            yield out.getvalue().encode("utf-8")
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode("utf-8")
+
+
+async def _stream_xlsx(orders):
+    # openpyxl en modo write_only vuelca las filas a disco; el libro se guarda en un temporal y se envía a trozos
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Pedidos")
+    ws.append(_EXPORT_ORDER_COLUMNS + _EXPORT_ITEM_COLUMNS)
+    async for order in orders:
+        for row in _export_rows(order):
+            ws.append(row)
+    fd, tmp_name = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        await asyncio.to_thread(wb.save, tmp_name)
+        with open(tmp_name, "rb") as f:
+            while chunk := f.read(64 * 1024):
+                yield chunk
+    finally:
+        os.unlink(tmp_name)
+
+
+@api_router.get("/admin/orders/export")
+async def export_orders(format: str = "csv", created_from: Optional[date] = None, created_to: Optional[date] = None,
+                        delivery_from: Optional[date] = None, delivery_to: Optional[date] = None,
+                        city: Optional[str] = None, status: Optional[str] = None,
+                        x_admin_key: Optional[str] = Header(None)):
+    """Exporta los pedidos filtrados (fechas inclusivas) como ndjson, csv o xlsx, en streaming."""
+    _require_admin(x_admin_key)
+    if format not in _EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format debe ser uno de: {sorted(_EXPORT_MEDIA_TYPES)}")
+    orders = _iter_export_orders(_export_query(created_from, created_to, delivery_from, delivery_to, city, status))
+    stream = {"ndjson": _stream_ndjson, "csv": _stream_csv, "xlsx": _stream_xlsx}[format](orders)
+    filename = f"pedidos-{datetime.now().strftime('%Y%m%d-%H%M')}.{format}"
+    return StreamingResponse(stream, media_type=_EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 
 @api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str):
-    if db is not None:
+    if db_available():
         try:
             order = await db.orders.find_one({"id": order_id})
             if order:
                 return Order(**order)
-        except Exception:
-            pass
-    for o in _orders_in_memory:
-        if o.get("id") == order_id:
-            return Order(**o)
+        except Exception as e:
+            _db_failed(e)
+            _FALLBACKS.inc("orders_read")
+    else:
+        _FALLBACKS.inc("orders_read")
+    o = _orders_in_memory.get(order_id)
+    if o is not None:
+        return Order(**o)
     raise HTTPException(status_code=404, detail="Pedido no encontrado")
 
 
@@ -1106,7 +3491,7 @@ async def update_order_status(order_id: str, status: str):
     if status not in valid_statuses:
         raise HTTPException(status_code=400, detail=f"Estado inválido. Debe ser uno de: {valid_statuses}")
     
-    if db is not None:
+    if db_available():
         try:
             result = await db.orders.update_one(
                 {"id": order_id},
@@ -1114,13 +3499,11 @@ async def update_order_status(order_id: str, status: str):
             )
             if result.modified_count > 0:
                 return {"message": "Estado actualizado", "status": status}
-        except Exception:
-            pass
-    for o in _orders_in_memory:
-        if o.get("id") == order_id:
-            o["status"] = status
-            o["updated_at"] = datetime.utcnow()
-            return {"message": "Estado actualizado", "status": status}
+        except Exception as e:
+            _db_failed(e)
+    if _orders_in_memory.set_status(order_id, status, datetime.utcnow()):
+        await _remember_order(_orders_in_memory.get(order_id))
+        return {"message": "Estado actualizado", "status": status}
     raise HTTPException(status_code=404, detail="Pedido no encontrado")
 
 
@@ -1128,9 +3511,8 @@ async def update_order_status(order_id: str, status: str):
 app.include_router(api_router)
 
 # Carpeta de imágenes de productos: pon aquí tus fotos (ver GUIA_IMAGENES_PRODUCTOS.md)
-STATIC_DIR = ROOT_DIR / "static"
 if STATIC_DIR.exists():
-    app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
+    app.mount("/static", CachedStaticFiles(directory=str(STATIC_DIR)), name="static")
 
 app.add_middleware(
     CORSMiddleware,
@@ -1138,18 +3520,183 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed"],
 )
 
+
+class _MetricsMiddleware:
+    """Middleware ASGI (sin BaseHTTPMiddleware, que añade una tarea por petición): mide cada petición por
+    plantilla de ruta ("/api/orders/{order_id}", no el id concreto) y código de estado."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or scope.get("root_path") or "unmatched"
+            _HTTP_LATENCY.observe(time.perf_counter() - t0, scope["method"], route, str(status))
+
+
+app.add_middleware(_MetricsMiddleware)
+
+
+def _metric_block(name: str, kind: str, help_text: str, samples: List[str]) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", *samples]
+
+
+def _threadpool_samples() -> List[str]:
+    lines = []
+    executor = getattr(asyncio.get_running_loop(), "_default_executor", None)  # asyncio.to_thread
+    if executor is not None:
+        lines += _metric_block("aqualan_threadpool_queue_depth", "gauge", "Tareas esperando un hilo libre",
+                               [f'aqualan_threadpool_queue_depth{{pool="asyncio"}} {executor._work_queue.qsize()}'])
+        lines += _metric_block("aqualan_threadpool_threads", "gauge", "Hilos arrancados en el pool",
+                               [f'aqualan_threadpool_threads{{pool="asyncio"}} {len(executor._threads)}'])
+    try:
+        import anyio.to_thread
+
+        stats = anyio.to_thread.current_default_thread_limiter().statistics()  # endpoints síncronos de Starlette
+        lines += _metric_block("aqualan_anyio_threads_waiting", "gauge", "Tareas esperando un hilo de anyio",
+                               [f"aqualan_anyio_threads_waiting {stats.tasks_waiting}"])
+        lines += _metric_block("aqualan_anyio_threads_busy", "gauge", "Hilos de anyio ocupados",
+                               [f"aqualan_anyio_threads_busy {stats.borrowed_tokens:g}"])
+    except Exception:
+        pass
+    return lines
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _METRICS:
+        lines += _metric_block(metric.name, metric.kind, metric.help, metric.samples())
+    lines += _metric_block("aqualan_mongo_up", "gauge", "1 si MongoDB responde según el monitor de salud",
+                           [f"aqualan_mongo_up {int(db_available())}"])
+    if _db_health["latency_ms"] is not None:
+        lines += _metric_block("aqualan_mongo_ping_seconds", "gauge", "Latencia del último ping a MongoDB",
+                               [f"aqualan_mongo_ping_seconds {_db_health['latency_ms'] / 1000:g}"])
+    breakers = _email_providers()
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    lines += _metric_block("aqualan_email_breaker_state", "gauge", "Circuito del proveedor (0 cerrado, 1 half-open, 2 abierto)",
+                           [f'aqualan_email_breaker_state{{provider="{b.name}"}} {states[b.state]}' for b in breakers])
+    lines += _metric_block("aqualan_email_provider_total", "counter", "Envíos por proveedor y resultado (skipped = circuito abierto)",
+                           [f'aqualan_email_provider_total{{provider="{b.name}",result="{k}"}} {v}'
+                            for b in breakers for k, v in b.stats.items()])
+    lines += _metric_block("aqualan_memory_orders", "gauge", "Pedidos en el almacén en memoria",
+                           [f"aqualan_memory_orders {len(_orders_in_memory)}"])
+    lines += _metric_block("aqualan_order_journal_unsynced", "gauge", "Pedidos del diario pendientes de subir a MongoDB",
+                           [f"aqualan_order_journal_unsynced {len(_order_journal.unsynced)}"])
+    lines += _threadpool_samples()
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Métricas en formato de texto de Prometheus."""
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def _build_product_images_async() -> None:
+    """Genera los derivados de imágenes sin bloquear el arranque; hasta entonces no hay image_variants."""
+    t0 = time.perf_counter()
+    try:
+        await asyncio.to_thread(build_product_images)
+        await asyncio.to_thread(_precompress_static_assets)
+    except Exception as e:
+        logger.warning("No se pudieron generar las imágenes de producto: %s", e)
+        return
+    invalidate_catalog_cache()
+    logger.info("Imágenes de producto listas en %.0f ms", (time.perf_counter() - t0) * 1000)
+
+
+# Tareas de fondo lanzadas al arrancar (se cancelan al apagar)
+_background_tasks: List[asyncio.Task] = []
+
+
+async def _run_startup_step(name: str, step) -> None:
+    """Ejecuta un paso de arranque, mide su duración y marca la app como lista al terminar el último."""
+    t0 = time.perf_counter()
+    try:
+        await step()
+    except Exception as e:
+        logger.warning("Paso de arranque '%s' falló: %s", name, e)
+    finally:
+        _startup_state["timings_ms"][name] = round((time.perf_counter() - t0) * 1000, 1)
+        _startup_state["pending"].remove(name)
+    if not _startup_state["pending"]:
+        _startup_state["ready"] = True
+        _startup_state["ready_after_ms"] = round((time.perf_counter() - _PROCESS_T0) * 1000, 1)
+        logger.info(
+            "Arranque completado (%s) en %.0f ms: %s",
+            "rápido" if FAST_STARTUP else "completo",
+            _startup_state["ready_after_ms"],
+            " ".join(f"{k}={v:.0f}ms" for k, v in _startup_state["timings_ms"].items()),
+        )
+
+
 @app.on_event("startup")
 async def startup_event():
-    _load_routes_from_excel()
-    await seed_products()
-    logger.info("Application started and products seeded — v2.1 WP Mail SMTP")
+    _startup_state["timings_ms"]["import"] = round((time.perf_counter() - _PROCESS_T0) * 1000, 1)
+    steps = [
+        ("rutas", lambda: asyncio.to_thread(_load_routes_from_excel)),
+        ("diario_pedidos", _replay_order_journal),
+        ("indices", ensure_indexes),
+        ("seed_products", seed_products),
+    ]
+    _startup_state["pending"] = {name for name, _ in steps}
+    # Un ping acotado antes de los pasos que usan MongoDB: si no responde, se saltan sin esperar timeouts
+    await _probe_db()
+    if FAST_STARTUP:
+        # Se empieza a servir ya con las rutas por defecto y los productos en memoria
+        for name, step in steps:
+            _background_tasks.append(asyncio.create_task(_run_startup_step(name, step)))
+    else:
+        for name, step in steps:
+            await _run_startup_step(name, step)
+    start_outbox_worker()
+    _background_tasks.append(asyncio.create_task(_build_product_images_async()))
+    if ROUTES_WATCH_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(_watch_routes_file()))
+    if ORDER_EMAIL_MODE != "per_order":
+        _background_tasks.append(asyncio.create_task(_digest_worker()))
+    if db is not None:
+        _background_tasks.append(asyncio.create_task(_db_health_monitor()))
+    logger.info("Application started — v2.1 WP Mail SMTP (arranque %s)", "rápido" if FAST_STARTUP else "completo")
     logger.info("Email config: WP Mail endpoint=%s | Resend fallback: %s", WP_MAIL_ENDPOINT, "sí" if RESEND_API_KEY else "no")
     logger.info("POST /api/offer-request disponible para solicitudes de oferta -> info@aqualan.es")
 
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await stop_outbox_worker()
+    await _close_email_http()
+    await _order_journal.close()
+    for task in _background_tasks:
+        task.cancel()
     if client is not None:
         client.close()
+
+
+if __name__ == "__main__":
+    # Uso: python server.py build-images [--force]
+    import sys
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "build-images":
+        result = build_product_images(force="--force" in sys.argv[2:])
+        print(f"{len(result)} imágenes de producto con derivados en {PRODUCT_IMAGES_DERIVED_DIR}")
+    else:
+        print("Uso: python server.py build-images [--force]")
+        sys.exit(2)
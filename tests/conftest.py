@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# server.py vive en backend/ y lee su configuración al importarse: los ficheros locales (diario, outbox,
+# artefacto de rutas) van a un directorio temporal y sin MONGO_URL todo usa los fallbacks en memoria.
+_TMP = Path(tempfile.mkdtemp(prefix="aqualan-tests-"))
+os.environ.pop("MONGO_URL", None)
+os.environ.setdefault("ORDER_JOURNAL_PATH", str(_TMP / "orders.journal"))
+os.environ.setdefault("OUTBOX_SQLITE_PATH", str(_TMP / "outbox.sqlite3"))
+os.environ.setdefault("ROUTES_ARTIFACT", str(_TMP / "rutas.compiled.json"))
+os.environ.setdefault("ROUTES_WATCH_INTERVAL", "0")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def _reset_state():
+    """Cada test empieza sin cubos de límite, claves de idempotencia ni pedidos en memoria."""
+    server._rate_buckets.clear()
+    server._idempotency_memory.clear()
+    server._idempotency_inflight.clear()
+    server._orders_in_memory = server._MemoryOrderStore(server.MEMORY_ORDERS_MAX)
+    yield
@@ -0,0 +1,177 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    store = server._SqliteOutbox(tmp_path / "outbox.sqlite3")
+    monkeypatch.setattr(server, "_sqlite_outbox", store)
+    monkeypatch.setattr(server.random, "random", lambda: 0.0)
+    server._outbox_unsaved.clear()
+    return store
+
+
+def _deliver(ok, provider="resend"):
+    async def deliver(to, subject, html):
+        return ok, provider if ok else None
+    return deliver
+
+
+def _row(store, msg_id):
+    row = store._connection().execute("SELECT * FROM email_outbox WHERE id = ?", (msg_id,)).fetchone()
+    return store._from_row(row)
+
+
+def _enqueue(store, **fields):
+    msg = {**server._new_outbox_message("cliente@example.com", "Pedido", "<p>hola</p>", "pedido_cliente", "o1"),
+           **fields}
+    asyncio.run(store.insert([msg]))
+    return msg
+
+
+# Outbox (user-013)
+
+def test_failed_send_is_retried_with_exponential_backoff(outbox, monkeypatch):
+    monkeypatch.setattr(server, "_deliver_email", _deliver(False))
+    msg = _enqueue(outbox)
+    delays = []
+    for attempt in range(1, 4):
+        now = datetime.utcnow() + timedelta(days=attempt)  # siempre después del siguiente intento
+        (claimed,) = asyncio.run(outbox.claim_due(now, 10))
+        asyncio.run(server._process_outbox_message(outbox, claimed))
+        row = _row(outbox, msg["id"])
+        assert row["status"] == "pending"
+        assert row["attempts"] == attempt
+        assert row["locked_at"] is None
+        delays.append((row["next_attempt_at"] - row["updated_at"]).total_seconds())
+    base = server.OUTBOX_RETRY_BASE_SECONDS
+    assert delays == [base, base * 2, base * 4]
+
+
+def test_backoff_is_capped(outbox, monkeypatch):
+    monkeypatch.setattr(server, "_deliver_email", _deliver(False))
+    monkeypatch.setattr(server, "OUTBOX_RETRY_MAX_SECONDS", 45.0)
+    msg = _enqueue(outbox, attempts=5)
+    (claimed,) = asyncio.run(outbox.claim_due(datetime.utcnow(), 10))
+    asyncio.run(server._process_outbox_message(outbox, claimed))
+    row = _row(outbox, msg["id"])
+    assert (row["next_attempt_at"] - row["updated_at"]).total_seconds() == 45.0
+
+
+def test_message_is_not_claimed_before_its_retry_time(outbox, monkeypatch):
+    monkeypatch.setattr(server, "_deliver_email", _deliver(False))
+    _enqueue(outbox)
+    (claimed,) = asyncio.run(outbox.claim_due(datetime.utcnow(), 10))
+    asyncio.run(server._process_outbox_message(outbox, claimed))
+    retry_at = _row(outbox, claimed["id"])["next_attempt_at"]
+    assert asyncio.run(outbox.claim_due(retry_at - timedelta(seconds=1), 10)) == []
+    assert len(asyncio.run(outbox.claim_due(retry_at, 10))) == 1
+
+
+def test_message_fails_after_max_attempts(outbox, monkeypatch):
+    monkeypatch.setattr(server, "_deliver_email", _deliver(False))
+    msg = _enqueue(outbox, attempts=server.OUTBOX_MAX_ATTEMPTS - 1)
+    (claimed,) = asyncio.run(outbox.claim_due(datetime.utcnow(), 10))
+    asyncio.run(server._process_outbox_message(outbox, claimed))
+    row = _row(outbox, msg["id"])
+    assert row["status"] == "failed"
+    assert row["attempts"] == server.OUTBOX_MAX_ATTEMPTS
+    assert asyncio.run(outbox.claim_due(datetime.utcnow() + timedelta(days=30), 10)) == []
+
+
+def test_sent_message_enqueues_its_copy(outbox, monkeypatch):
+    monkeypatch.setattr(server, "_deliver_email", _deliver(True))
+    msg = _enqueue(outbox, copy_to="info@example.com")
+    (claimed,) = asyncio.run(outbox.claim_due(datetime.utcnow(), 10))
+    asyncio.run(server._process_outbox_message(outbox, claimed))
+    row = _row(outbox, msg["id"])
+    assert (row["status"], row["provider"], row["attempts"]) == ("sent", "resend", 1)
+    (copy,) = asyncio.run(outbox.claim_due(datetime.utcnow(), 10))
+    assert copy["to"] == "info@example.com"
+    assert copy["kind"] == "pedido_cliente_copia"
+    assert copy["copy_to"] is None
+
+
+def test_sending_lock_expires(outbox):
+    _enqueue(outbox)
+    t0 = datetime.utcnow()
+    assert len(asyncio.run(outbox.claim_due(t0, 10))) == 1
+    assert asyncio.run(outbox.claim_due(t0 + server.OUTBOX_LOCK_TIMEOUT - timedelta(seconds=1), 10)) == []
+    (reclaimed,) = asyncio.run(outbox.claim_due(t0 + server.OUTBOX_LOCK_TIMEOUT + timedelta(seconds=1), 10))
+    assert reclaimed["status"] == "sending"
+    assert asyncio.run(outbox.counts()) == {"sending": 1}
+
+
+def test_unsaved_status_is_retried_before_claiming(outbox, monkeypatch):
+    monkeypatch.setattr(server, "_deliver_email", _deliver(True))
+    msg = _enqueue(outbox)
+    update = outbox.update
+
+    async def broken_update(msg_id, fields):
+        raise OSError("disco lleno")
+
+    monkeypatch.setattr(outbox, "update", broken_update)
+    (claimed,) = asyncio.run(outbox.claim_due(datetime.utcnow(), 10))
+    asyncio.run(server._process_outbox_message(outbox, claimed))
+    assert ("sqlite", msg["id"]) in server._outbox_unsaved
+    assert asyncio.run(server._outbox_flush_unsaved()) == {"sqlite"}
+
+    monkeypatch.setattr(outbox, "update", update)
+    assert asyncio.run(server._outbox_flush_unsaved()) == set()
+    assert _row(outbox, msg["id"])["status"] == "sent"
+    assert server._outbox_unsaved == {}
+
+
+# Circuit breaker de proveedores (user-015)
+
+@pytest.fixture
+def breaker():
+    return server._ProviderBreaker("prueba", _deliver(True))
+
+
+def _trip(breaker):
+    for _ in range(server.EMAIL_BREAKER_FAILURES):
+        assert breaker.allow()
+        breaker.record(False, 0.01)
+
+
+def test_breaker_opens_after_consecutive_failures(breaker):
+    for _ in range(server.EMAIL_BREAKER_FAILURES - 1):
+        breaker.record(False, 0.01)
+    assert breaker.state == "closed"
+    breaker.record(True, 0.01)
+    assert breaker.failures == 0
+    _trip(breaker)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.stats["skipped"] == 1
+
+
+def test_breaker_lets_one_probe_through_after_cooldown(breaker):
+    _trip(breaker)
+    breaker.opened_at -= server.EMAIL_BREAKER_COOLDOWN
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # solo una prueba a la vez
+
+
+def test_breaker_closes_when_probe_succeeds(breaker):
+    _trip(breaker)
+    breaker.opened_at -= server.EMAIL_BREAKER_COOLDOWN
+    assert breaker.allow()
+    breaker.record(True, 0.01)
+    assert (breaker.state, breaker.failures) == ("closed", 0)
+    assert breaker.allow()
+
+
+def test_breaker_reopens_when_probe_fails(breaker):
+    _trip(breaker)
+    breaker.opened_at -= server.EMAIL_BREAKER_COOLDOWN
+    assert breaker.allow()
+    breaker.record(False, 0.01)
+    assert breaker.state == "open"
+    assert not breaker.allow()  # el enfriamiento vuelve a empezar
@@ -0,0 +1,256 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server
+
+ORDER = {
+    "customer_name": "Ane",
+    "customer_email": "ane@example.com",
+    "customer_phone": "600000000",
+    "delivery_address": "Calle Mayor 1",
+    "delivery_city": "Getxo",
+    "items": [],
+}
+
+
+@pytest.fixture
+def client():
+    # Sin "with": no se lanzan las tareas de arranque (outbox, diario, MongoDB)
+    return TestClient(server.app)
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = server._OrderJournal(tmp_path / "orders.journal")
+    monkeypatch.setattr(server, "_order_journal", journal)
+    return journal
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    from mongomock_motor import AsyncMongoMockClient
+
+    db = AsyncMongoMockClient()["aqualan_test"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setitem(server._db_health, "up", True)
+    return db
+
+
+def _order_doc(n, created_at, email="ane@example.com"):
+    return server.Order(**{**ORDER, "customer_email": email}, id=f"o{n:03d}", created_at=created_at).model_dump()
+
+
+def _pages(client, limit, **params):
+    ids, cursor = [], None
+    while True:
+        r = client.get("/api/orders", params={"limit": limit, **params, **({"cursor": cursor} if cursor else {})})
+        assert r.status_code == 200
+        ids.append([o["id"] for o in r.json()])
+        cursor = r.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return ids
+
+
+# Paginación por clave (user-018 / user-020)
+
+def test_keyset_pages_cover_every_order_once_in_order(client):
+    t0 = datetime(2026, 3, 1)
+    docs = [_order_doc(n, t0 + timedelta(minutes=n // 3)) for n in range(25)]  # empates de created_at
+    for doc in docs:
+        server._orders_in_memory.add(doc)
+    pages = _pages(client, 7)
+    assert [len(p) for p in pages] == [7, 7, 7, 4]
+    expected = [d["id"] for d in sorted(docs, key=lambda d: (d["created_at"], d["id"]), reverse=True)]
+    assert [i for p in pages for i in p] == expected
+
+
+def test_keyset_pages_are_stable_under_concurrent_inserts(client):
+    t0 = datetime(2026, 3, 1)
+    for n in range(10):
+        server._orders_in_memory.add(_order_doc(n, t0 + timedelta(minutes=n)))
+    r = client.get("/api/orders", params={"limit": 4})
+    first = [o["id"] for o in r.json()]
+    # Llegan pedidos nuevos entre página y página: no desplazan los ya listados
+    for n in range(10, 15):
+        server._orders_in_memory.add(_order_doc(n, t0 + timedelta(minutes=n)))
+    rest = _pages(client, 4, cursor=r.headers["X-Next-Cursor"])
+    seen = first + [i for p in rest for i in p]
+    assert seen == [f"o{n:03d}" for n in range(9, -1, -1)]
+
+
+def test_keyset_pages_filter_by_email(client):
+    t0 = datetime(2026, 3, 1)
+    for n in range(12):
+        server._orders_in_memory.add(_order_doc(n, t0 + timedelta(minutes=n),
+                                                email="ane@example.com" if n % 2 else "jon@example.com"))
+    pages = _pages(client, 4, email="jon@example.com")
+    assert [i for p in pages for i in p] == [f"o{n:03d}" for n in range(10, -1, -2)]
+
+
+def test_invalid_cursor_and_limit_are_rejected(client):
+    assert client.get("/api/orders", params={"cursor": "no-es-un-cursor"}).status_code == 400
+    assert client.get("/api/orders", params={"limit": 0}).status_code == 400
+    assert client.get("/api/orders", params={"limit": server.ORDERS_PAGE_MAX + 1}).status_code == 400
+
+
+# Diario de pedidos (user-021)
+
+def test_replay_ignores_torn_last_line_and_keeps_latest_version(journal):
+    old = _order_doc(1, datetime(2026, 3, 1))
+    new = {**old, "status": "entregado"}
+    other = _order_doc(2, datetime(2026, 3, 2))
+    lines = [json.dumps(d, default=server._json_default) for d in (old, other, new)]
+    journal.path.write_text("\n".join(lines) + "\n" + lines[0][:20], encoding="utf-8")
+
+    assert asyncio.run(journal.replay()) == 2
+    assert journal.unsynced["o001"]["status"] == "entregado"
+    assert journal.unsynced["o001"]["created_at"] == datetime(2026, 3, 1)
+    assert server._orders_in_memory.get("o002") is not None
+
+
+def test_replay_does_not_overwrite_orders_written_since_startup(journal):
+    old = _order_doc(1, datetime(2026, 3, 1))
+    journal.path.write_text(json.dumps(old, default=server._json_default) + "\n", encoding="utf-8")
+    live = {**old, "status": "enviado"}
+    journal.unsynced["o001"] = live
+    asyncio.run(journal.replay())
+    assert journal.unsynced["o001"] is live
+
+
+def test_sync_upserts_and_compacts_the_journal(journal, mongo):
+    docs = [_order_doc(n, datetime(2026, 3, 1) + timedelta(minutes=n)) for n in range(3)]
+
+    async def run():
+        await asyncio.gather(*(journal.append(doc) for doc in docs))
+        synced = await journal.sync()
+        again = await journal.sync()
+        return synced, again, await mongo.orders.count_documents({})
+
+    assert asyncio.run(run()) == (3, 0, 3)
+    assert journal.unsynced == {}
+    assert journal.path.read_text(encoding="utf-8") == ""
+    assert journal.stats["fsyncs"] == 1  # las tres escrituras compartieron un fsync
+
+
+def test_sync_keeps_orders_changed_while_uploading(journal, mongo, monkeypatch):
+    doc = _order_doc(1, datetime(2026, 3, 1))
+    journal.unsynced[doc["id"]] = doc
+    collection = type(mongo.orders)  # motor crea un objeto colección en cada acceso
+    bulk_write = collection.bulk_write
+
+    async def racing_bulk_write(self, *args, **kwargs):
+        journal.unsynced[doc["id"]] = {**doc, "status": "cancelado"}
+        return await bulk_write(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "bulk_write", racing_bulk_write)
+    asyncio.run(journal.sync())
+    assert journal.unsynced[doc["id"]]["status"] == "cancelado"
+    (line,) = journal.path.read_text(encoding="utf-8").splitlines()
+    assert json.loads(line)["status"] == "cancelado"
+
+
+# Idempotency-Key (user-023)
+
+def test_repeated_key_replays_the_original_order(client):
+    first = client.post("/api/orders", json=ORDER, headers={"Idempotency-Key": "k1"})
+    second = client.post("/api/orders", json=ORDER, headers={"Idempotency-Key": "k1"})
+    assert first.status_code == second.status_code == 200
+    assert second.json()["id"] == first.json()["id"]
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert len(server._orders_in_memory) == 1
+
+
+def test_repeated_key_with_another_order_is_a_conflict(client):
+    assert client.post("/api/orders", json=ORDER, headers={"Idempotency-Key": "k1"}).status_code == 200
+    r = client.post("/api/orders", json={**ORDER, "notes": "otro"}, headers={"Idempotency-Key": "k1"})
+    assert r.status_code == 409
+    assert len(server._orders_in_memory) == 1
+
+
+def test_invalid_idempotency_key_is_rejected(client):
+    r = client.post("/api/orders", json=ORDER, headers={"Idempotency-Key": "x" * 256})
+    assert r.status_code == 400
+
+
+def test_concurrent_requests_with_same_key_create_once():
+    order_data = server.OrderCreate(**ORDER)
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return server.Order(**ORDER)
+
+    async def run():
+        return await asyncio.gather(*(server._create_order_once("k1", order_data, create) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert len({record["order"]["id"] for record, _ in results}) == 1
+    assert [replayed for _, replayed in results] == [False, True, True, True, True]
+    assert server._idempotency_inflight == {}
+
+
+def test_failed_creation_is_not_remembered():
+    order_data = server.OrderCreate(**ORDER)
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=503)
+
+    async def ok():
+        return server.Order(**ORDER)
+
+    async def run():
+        results = await asyncio.gather(*(server._create_order_once("k1", order_data, fail) for _ in range(3)),
+                                       return_exceptions=True)
+        return results, await server._create_order_once("k1", order_data, ok)
+
+    results, (record, replayed) = asyncio.run(run())
+    assert all(isinstance(r, HTTPException) for r in results)
+    assert not replayed
+    assert record["fingerprint"] == server._order_fingerprint(order_data)
+
+
+# Límite de peticiones (user-024)
+
+def test_token_bucket_spends_and_refills():
+    key = ("orders", "ip:1.2.3.4")
+    assert [server._take_token(key, 3, 1.0, 100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert server._take_token(key, 3, 1.0, 100.0) == pytest.approx(1.0)
+    assert server._take_token(key, 3, 1.0, 100.5) == pytest.approx(0.5)
+    assert server._take_token(key, 3, 1.0, 101.0) == 0.0
+    # Tras mucho tiempo parado el cubo no pasa de su capacidad
+    assert [server._take_token(key, 3, 1.0, 1000.0) for _ in range(4)][-1] == pytest.approx(1.0)
+
+
+def test_rate_limit_returns_429_with_retry_after(client, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "orders", (2, 2 / 60))
+    statuses = [client.post("/api/orders", json=ORDER).status_code for _ in range(2)]
+    r = client.post("/api/orders", json=ORDER)
+    assert statuses == [200, 200]
+    assert r.status_code == 429
+    assert r.headers["Retry-After"] == "30"
+
+
+def test_rate_limit_applies_per_email_across_ips(client, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "orders", (1, 1 / 60))
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+    first = client.post("/api/orders", json=ORDER, headers={"X-Forwarded-For": "1.1.1.1"})
+    second = client.post("/api/orders", json=ORDER, headers={"X-Forwarded-For": "2.2.2.2"})
+    other = client.post("/api/orders", json={**ORDER, "customer_email": "jon@example.com"},
+                        headers={"X-Forwarded-For": "3.3.3.3"})
+    assert (first.status_code, second.status_code, other.status_code) == (200, 429, 200)
+
+
+def test_idempotent_replay_does_not_spend_tokens(client, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "orders", (1, 1 / 60))
+    statuses = [client.post("/api/orders", json=ORDER, headers={"Idempotency-Key": "k1"}).status_code
+                for _ in range(3)]
+    assert statuses == [200, 200, 200]
@@ -0,0 +1,210 @@
+import os
+import shutil
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+import server
+
+ROUTES_14 = {
+    "getxo": {"semana": 2, "days": [2]},
+    "santurtzi": {"semana": 1, "days": [1, 3]},
+}
+ROUTES_7 = {
+    "bilbao": [0, 3],
+    "getxo": [0],
+    "las arenas": [2],
+    "santander": [4],
+    "bilbao-santutxu": [1],
+}
+
+
+@pytest.fixture
+def index():
+    return server._build_route_index(ROUTES_14, ROUTES_7)
+
+
+@pytest.fixture
+def installed_routes():
+    """Permite publicar otras rutas en el test; al terminar se restauran las originales."""
+    original = server.ROUTES_14_DAYS
+    yield
+    server._install_routes(original)
+
+
+def _key(city, index):
+    entry = server._resolve_route(city, index)
+    return None if entry is None else entry["key"]
+
+
+class _FixedDatetime(datetime):
+    current = datetime(2026, 3, 4, 9, 0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+# Índice de rutas (user-001)
+
+@pytest.mark.parametrize("city, expected", [
+    ("bilbao", "bilbao"),
+    ("  BILBAO ", "bilbao"),
+    ("Bilbao - Santutxu", "bilbao-santutxu"),
+    ("bilbao,santutxu", "bilbao-santutxu"),
+    ("Sánturtzi", "santurtzi"),
+])
+def test_exact_match_ignores_case_accents_and_separators(index, city, expected):
+    assert _key(city, index) == expected
+
+
+def test_14_day_route_wins_over_weekly_route_with_same_name(index):
+    entry = server._resolve_route("getxo", index)
+    assert entry["semana"] == 2
+    assert entry["days"] == [2]
+
+
+def test_longest_fragment_wins_then_leftmost(index):
+    assert _key("playa de las arenas getxo", index) == "las arenas"
+    assert _key("getxo bilbao", index) == "getxo"
+    assert _key("calle mayor 3 bilbao", index) == "bilbao"
+
+
+def test_prefix_match_mid_word(index):
+    assert _key("santu", index) == "santurtzi"
+    assert _key("las aren", index) == "las arenas"
+    assert _key("bilbao sant", index) == "bilbao"  # un fragmento exacto gana al prefijo
+    assert _key("sa", index) is None  # menos de _ROUTE_MIN_PREFIX letras
+
+
+def test_prefix_tie_goes_to_shortest_then_alphabetical(index):
+    # "bil" empieza "bilbao" y "bilbao-santutxu": gana el nombre más corto
+    assert _key("bil", index) == "bilbao"
+    # "sant" empieza "santander" y "santurtzi" (misma longitud): gana el alfabético
+    assert _key("sant", index) == "santander"
+
+
+def test_token_and_token_prefix_match(index):
+    assert _key("santutxu", index) == "bilbao-santutxu"
+    assert _key("arenas", index) == "las arenas"
+    assert _key("aren", index) == "las arenas"
+
+
+def test_stopwords_and_unknown_cities_do_not_match(index):
+    assert _key("de", index) is None
+    assert _key("madrid", index) is None
+    assert _key("", index) is None
+    assert _key("  --  ", index) is None
+
+
+def test_resolution_does_not_depend_on_dict_order():
+    reversed_index = server._build_route_index(dict(reversed(ROUTES_14.items())), dict(reversed(ROUTES_7.items())))
+    index = server._build_route_index(ROUTES_14, ROUTES_7)
+    for city in ("sant", "bil", "aren", "santutxu", "las arenas getxo"):
+        assert _key(city, reversed_index) == _key(city, index)
+
+
+# Caché de fechas de entrega (user-002)
+
+def test_delivery_cache_hits_within_epoch(monkeypatch):
+    monkeypatch.setattr(server, "datetime", _FixedDatetime)
+    server._clear_delivery_cache()
+    before = server.delivery_cache_stats()
+    first = server.get_next_delivery_date("Getxo")
+    second = server.get_next_delivery_date("GETXO ")
+    stats = server.delivery_cache_stats()
+    assert first == second == server._compute_delivery_info("getxo", _FixedDatetime.current)
+    assert stats["misses"] - before["misses"] == 1
+    assert stats["hits"] - before["hits"] == 1
+
+
+def test_delivery_cache_returns_copies(monkeypatch):
+    monkeypatch.setattr(server, "datetime", _FixedDatetime)
+    server._clear_delivery_cache()
+    server.get_next_delivery_date("bilbao")["date"] = "roto"
+    assert server.get_next_delivery_date("bilbao")["date"] != "roto"
+
+
+@pytest.mark.parametrize("later", [
+    datetime(2026, 3, 4, 10, 0),  # pasado el corte de las 10:00
+    datetime(2026, 3, 5, 8, 0),  # día siguiente
+])
+def test_delivery_cache_epoch_changes_with_day_and_cutoff(monkeypatch, later):
+    monkeypatch.setattr(server, "datetime", _FixedDatetime)
+    monkeypatch.setattr(_FixedDatetime, "current", datetime(2026, 3, 4, 9, 59))
+    server.get_next_delivery_date("bilbao")
+    before = server.delivery_cache_stats()
+    monkeypatch.setattr(_FixedDatetime, "current", later)
+    info = server.get_next_delivery_date("bilbao")
+    stats = server.delivery_cache_stats()
+    assert stats["misses"] - before["misses"] == 1
+    assert stats["invalidations"] - before["invalidations"] == 1
+    assert info == server._compute_delivery_info("bilbao", later)
+
+
+def test_delivery_cache_invalidated_when_routes_are_installed(monkeypatch, installed_routes):
+    monkeypatch.setattr(server, "datetime", _FixedDatetime)
+    old = server.get_next_delivery_date("getxo")
+    generation = server._ROUTE_INDEX["generation"]
+    server._install_routes({**server.ROUTES_14_DAYS, "getxo": {"semana": 1, "days": [4]}})
+    new = server.get_next_delivery_date("getxo")
+    assert server._ROUTE_INDEX["generation"] > generation
+    assert new["day_name"] == "Viernes"
+    assert new != old
+
+
+# Calendario de reparto (user-004)
+
+@pytest.mark.parametrize("now", [datetime(2026, 3, 2) + timedelta(days=d, hours=h)
+                                 for d in range(14) for h in (8, 11)])
+def test_calendar_matches_get_next_delivery_date(now):
+    index = server._ROUTE_INDEX
+    n = 4
+    for row in server._build_delivery_calendar(now, n, index):
+        assert len(row["dates"]) == n
+        assert row["dates"][0] == server._compute_delivery_info(row["city"], now, index)["date"]
+        for prev, nxt in zip(row["dates"], row["dates"][1:]):
+            day_after = datetime.fromisoformat(prev) + timedelta(days=1)
+            assert nxt == server._compute_delivery_info(row["city"], day_after, index)["date"]
+
+
+# rutas.xlsx y su artefacto compilado (user-005)
+
+@pytest.fixture
+def routes_xlsx(tmp_path, monkeypatch):
+    xlsx = tmp_path / "rutas.xlsx"
+    shutil.copy(Path(server.ROOT_DIR).parent / "rutas.xlsx", xlsx)
+    monkeypatch.setattr(server, "ROUTES_ARTIFACT", tmp_path / "rutas.compiled.json")
+    return xlsx
+
+
+def test_artifact_matches_excel_parser(routes_xlsx, monkeypatch):
+    parsed = server._parse_routes_excel(routes_xlsx)
+    assert parsed
+    assert server._read_routes_artifact(routes_xlsx) is None
+    assert server._read_excel_routes(routes_xlsx) == parsed
+    assert server.ROUTES_ARTIFACT.exists()
+
+    def fail(path):
+        raise AssertionError("no debería volver a parsear el Excel")
+
+    monkeypatch.setattr(server, "_parse_routes_excel", fail)
+    assert server._read_excel_routes(routes_xlsx) == parsed
+
+
+def test_artifact_survives_touch_but_not_content_change(routes_xlsx):
+    routes = server._read_excel_routes(routes_xlsx)
+    st = routes_xlsx.stat()
+    os.utime(routes_xlsx, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert server._read_routes_artifact(routes_xlsx) == routes
+
+    with open(routes_xlsx, "ab") as f:
+        f.write(b"\0")
+    assert server._read_routes_artifact(routes_xlsx) is None
+
+
+def test_stale_artifact_version_is_ignored(routes_xlsx, monkeypatch):
+    server._read_excel_routes(routes_xlsx)
+    monkeypatch.setattr(server, "_ROUTES_ARTIFACT_VERSION", server._ROUTES_ARTIFACT_VERSION + 1)
+    assert server._read_routes_artifact(routes_xlsx) is None